@@ -3,21 +3,32 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import yfinance as yf
-from datetime import datetime, timedelta, date
+from datetime import datetime, timedelta, date, timezone
 import sqlite3
 import io
 import csv
 import os
 import base64
 import json
+import time
+import threading
+import pickle
+import socket
+import zlib
+import gzip
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, unquote
 from typing import Optional
 
+import compute_pool
+
 # --- HTTP (requests preferred; fallback to stdlib urllib) ---
 try:
     import requests
     _HTTP_LIB = "requests"
 except Exception:
-    import urllib.request, urllib.parse
+    import urllib.request, urllib.parse, urllib.error
     _HTTP_LIB = "urllib"
 
 # --- Timezone helper (ZoneInfo on Python 3.9+) ---
@@ -26,6 +37,12 @@ try:
 except Exception:
     ZoneInfo = None  # fallback to UTC if not available
 
+# --- yfinance's rate-limit exception (yfinance 0.2.5x+) ---
+try:
+    from yfinance.exceptions import YFRateLimitError
+except Exception:
+    YFRateLimitError = None
+
 # --- Exchange calendars (optional) ---
 try:
     import exchange_calendars as xcals
@@ -36,6 +53,96 @@ except Exception:
 
 DB_PATH = "stocks.db"
 
+# -----------------------------
+# HTTP cassette (record / replay every network response)
+# -----------------------------
+# record: every outbound call goes to the network and its response is kept;
+# replay: responses come only from the cassette (no network; unknown calls
+# return their empty default). Both modes bypass the shared cache and bar
+# store so a recorded run captures, and a replay reproduces, every call.
+# Mode and file are operator settings (CASSETTE_MODE / CASSETTE_FILE in
+# st.secrets or the environment), fixed for the process; files live only in
+# CASSETTE_DIR since replay unpickles them.
+CASSETTE_MODES = ["off", "record", "replay"]
+CASSETTE_DIR = "cassettes"
+CASSETTE_DEFAULT_FILE = "run.pkl.gz"
+
+def _cassette_setting(name: str, default: str) -> str:
+    return str(st.secrets.get(name) or os.environ.get(name) or default).strip()
+
+def cassette_file_path(name: str) -> Optional[str]:
+    """name resolved inside CASSETTE_DIR; None if it would escape it."""
+    root = os.path.realpath(CASSETTE_DIR)
+    path = os.path.realpath(os.path.join(root, os.path.basename(name or CASSETTE_DEFAULT_FILE)))
+    return path if os.path.dirname(path) == root else None
+
+@st.cache_resource
+def _cassette():
+    """Process-wide cassette, configured once at process start."""
+    mode = _cassette_setting("CASSETTE_MODE", "off").lower()
+    path = cassette_file_path(_cassette_setting("CASSETTE_FILE", CASSETTE_DEFAULT_FILE))
+    if mode not in CASSETTE_MODES or path is None:
+        mode = "off"
+    return {"lock": threading.Lock(), "mode": mode, "path": path,
+            "entries": _cassette_read(path) if mode == "replay" else {},
+            "dirty": False, "stats": {"recorded": 0, "replayed": 0, "missing": 0}}
+
+def cassette_mode() -> str:
+    return _cassette()["mode"]
+
+def cassette_active() -> bool:
+    return cassette_mode() != "off"
+
+def _cassette_read(path: str) -> dict:
+    try:
+        with open(path, "rb") as f:
+            return pickle.loads(zlib.decompress(f.read()))
+    except FileNotFoundError:
+        return {}
+
+def cassette_save() -> Optional[str]:
+    """Write recorded entries to the cassette file; returns the path written, if any."""
+    cas = _cassette()
+    with cas["lock"]:
+        if cas["mode"] != "record" or not cas["dirty"]:
+            return None
+        path, blob = cas["path"], zlib.compress(pickle.dumps(cas["entries"], protocol=pickle.HIGHEST_PROTOCOL))
+        cas["dirty"] = False
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(blob)
+    os.replace(tmp, path)
+    return path
+
+def cassette_status() -> dict:
+    cas = _cassette()
+    with cas["lock"]:
+        return {"mode": cas["mode"], "path": cas["path"], "entries": len(cas["entries"]), **cas["stats"]}
+
+def cassette_call(key: tuple, live, default=None):
+    """
+    Route one outbound call through the cassette: live() in off/record mode
+    (recording the response), the recorded response in replay mode.
+    """
+    cas = _cassette()
+    mode = cas["mode"]
+    if mode == "replay":
+        with cas["lock"]:
+            if key in cas["entries"]:
+                cas["stats"]["replayed"] += 1
+                return pickle.loads(cas["entries"][key])
+            cas["stats"]["missing"] += 1
+        return default
+    value = live()
+    if mode == "record":
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with cas["lock"]:
+            cas["entries"][key] = blob
+            cas["dirty"] = True
+            cas["stats"]["recorded"] += 1
+    return value
+
 # =============================
 # GitHub-backed storage (CSV in repo)
 # =============================
@@ -67,6 +174,9 @@ def gh_get_file(path: str):
     repo, branch = _gh_repo()
     if not repo:
         return None
+    return cassette_call(("gh.contents", repo, branch, path), lambda: _gh_get_file_live(repo, branch, path))
+
+def _gh_get_file_live(repo: str, branch: str, path: str):
     url = f"https://api.github.com/repos/{repo}/contents/{path}"
     for scheme in ("token", "bearer"):
         headers = _gh_headers_auth(scheme)
@@ -91,10 +201,76 @@ def gh_get_file(path: str):
             continue
     return None
 
+# --- Raw reads: the contents API drops inline base64 for files over 1 MB, so CSVs are
+# fetched with the raw media type and parsed straight off the socket in chunks ---
+GH_CSV_CHUNK_ROWS = 5000
+
+def _gh_raw_stream(repo: str, branch: str, path: str):
+    """Open a repo file as a binary stream (caller closes); None if unavailable."""
+    url = f"https://api.github.com/repos/{repo}/contents/{path}"
+    for scheme in ("token", "bearer"):
+        headers = _gh_headers_auth(scheme)
+        if not headers:
+            return None
+        headers = {k: v for k, v in headers.items() if k != "Content-Type"}
+        headers["Accept"] = "application/vnd.github.raw"
+        try:
+            if _HTTP_LIB == "requests":
+                r = requests.get(url, params={"ref": branch}, headers=headers, timeout=20, stream=True)
+                if r.status_code == 200:
+                    r.raw.decode_content = True  # undo any gzip transfer encoding
+                    return r.raw
+                r.close()
+                if r.status_code == 401:
+                    continue  # try next scheme
+                return None
+            else:
+                full = f"{url}?{urllib.parse.urlencode({'ref': branch})}"
+                req = urllib.request.Request(full, headers=headers)
+                return urllib.request.urlopen(req, timeout=20)
+        except Exception:
+            if scheme == "bearer":
+                return None
+            continue
+    return None
+
+def _gh_raw_bytes(repo: str, branch: str, path: str) -> Optional[bytes]:
+    stream = _gh_raw_stream(repo, branch, path)
+    if stream is None:
+        return None
+    try:
+        return stream.read()
+    finally:
+        stream.close()
+
+def gh_csv_chunks(path: str, chunksize: int = GH_CSV_CHUNK_ROWS, **read_kw):
+    """
+    Yield a repo CSV as DataFrame chunks (nothing if missing/unconfigured).
+    String-typed with blanks kept by default; read_kw overrides pd.read_csv options.
+    """
+    repo, branch = _gh_repo()
+    if not repo:
+        return
+    if cassette_active():
+        # cassettes store whole responses; fine for test fixtures
+        data = cassette_call(("gh.raw", repo, branch, path), lambda: _gh_raw_bytes(repo, branch, path))
+        stream = io.BytesIO(data) if data is not None else None
+    else:
+        stream = _gh_raw_stream(repo, branch, path)
+    if stream is None:
+        return
+    try:
+        opts = {"encoding": "utf-8-sig", "keep_default_na": False, "dtype": str, **read_kw}
+        yield from pd.read_csv(stream, chunksize=chunksize, **opts)
+    finally:
+        stream.close()
+
 def gh_put_file(path: str, content_bytes: bytes, message: str, sha: Optional[str]):
     repo, branch = _gh_repo()
     if not repo:
         return False, "GitHub not configured"
+    if cassette_mode() == "replay":
+        return False, "Replaying a cassette: nothing pushed"
     url = f"https://api.github.com/repos/{repo}/contents/{path}"
     payload = {
         "message": message,
@@ -117,58 +293,54 @@ def gh_put_file(path: str, content_bytes: bytes, message: str, sha: Optional[str
                 return False, f"{r.status_code}: {r.text[:200]}"
             else:
                 req = urllib.request.Request(url, data=body, headers=headers, method="PUT")
-                with urllib.request.urlopen(req, timeout=30) as resp:
-                    code = resp.getcode()
-                    if code in (200, 201):
-                        return True, "Committed"
-                    return False, f"{code}: {resp.read(200)}"
+                try:
+                    with urllib.request.urlopen(req, timeout=30) as resp:
+                        code = resp.getcode()
+                        if code in (200, 201):
+                            return True, "Committed"
+                        return False, f"{code}: {resp.read(200)}"
+                except urllib.error.HTTPError as e:  # keep the "<status>: <text>" shape callers parse
+                    if e.code == 401 and scheme != "bearer":
+                        continue
+                    return False, f"{e.code}: {e.read(200)}"
         except Exception as e:
             if scheme == "bearer":
                 return False, f"Commit failed: {e}"
             continue
     return False, "401: Bad credentials (check token scope/SSO/repo access)"
 
+def gh_put_conflict(msg: str) -> bool:
+    """gh_put_file failed because the file moved under us (stale or missing sha)."""
+    return msg.split(":", 1)[0] in ("409", "422")
+
 def seed_db_from_github():
-    """Fetch CSVs from repo and upsert into local SQLite tables."""
+    """Stream CSVs from repo and upsert into local SQLite tables, one transaction per chunk."""
     # stocks.csv
-    meta = gh_get_file(GH_STOCKS_PATH)
-    if meta and "content" in meta:
-        try:
-            csv_bytes = base64.b64decode(meta["content"])
-            df = pd.read_csv(io.BytesIO(csv_bytes), encoding="utf-8-sig", keep_default_na=False)
-            for _, r in df.iterrows():
-                t = str(r.get("ticker","")).strip()
-                n = str(r.get("name","")).strip()
-                rg = str(r.get("region","")).strip()
-                cu = str(r.get("currency","")).strip()
-                if t and n and rg and cu:
-                    db_add_stock(t, n, rg, cu)
-        except Exception:
-            pass
+    try:
+        for df in gh_csv_chunks(GH_STOCKS_PATH):
+            cols = {c.strip().lower(): c for c in df.columns}
+            if not {"ticker", "name", "region", "currency"}.issubset(cols):
+                break
+            recs = [tuple(v.strip() for v in rec)
+                    for rec in zip(df[cols["ticker"]], df[cols["name"]], df[cols["region"]], df[cols["currency"]])]
+            db_add_stocks_bulk([r for r in recs if all(r)])
+    except Exception:
+        pass
 
     # reference_prices.csv
-    meta = gh_get_file(GH_BASELINES_PATH)
-    if meta and "content" in meta:
-        try:
-            csv_bytes = base64.b64decode(meta["content"])
-            df = pd.read_csv(io.BytesIO(csv_bytes), encoding="utf-8-sig", keep_default_na=False)
+    try:
+        for df in gh_csv_chunks(GH_BASELINES_PATH):
             cols = {c.strip().lower(): c for c in df.columns}
-            req = {"ticker","year","price"}
-            if req.issubset(set(cols.keys())):
-                for _, r in df.iterrows():
-                    try:
-                        db_set_reference(
-                            str(r[cols["ticker"]]).strip(),
-                            int(pd.to_numeric(r[cols["year"]], errors="coerce")),
-                            float(pd.to_numeric(r[cols["price"]], errors="coerce")),
-                            None if "date" not in cols else (None if pd.isna(r[cols["date"]]) else str(r[cols["date"]])),
-                            None if "series" not in cols else (None if pd.isna(r[cols["series"]]) else str(r[cols["series"]])),
-                            None if "notes" not in cols else (None if pd.isna(r[cols["notes"]]) else str(r[cols["notes"]]))
-                        )
-                    except Exception:
-                        continue
-        except Exception:
-            pass
+            if not {"ticker", "year", "price"}.issubset(cols):
+                break
+            year = pd.to_numeric(df[cols["year"]], errors="coerce")
+            price = pd.to_numeric(df[cols["price"]], errors="coerce")
+            ok = year.notna() & price.notna() & (df[cols["ticker"]].str.strip() != "")
+            opt = {k: (df[cols[k]] if k in cols else pd.Series("", index=df.index)) for k in ("date", "series", "notes")}
+            db_set_references_bulk(zip(df[cols["ticker"]][ok], year[ok], price[ok],
+                                       opt["date"][ok], opt["series"][ok], opt["notes"][ok]))
+    except Exception:
+        pass
 
 def sync_db_to_github(note: str = ""):
     """Dump both tables to CSV and commit to repo."""
@@ -207,20 +379,96 @@ def sync_db_to_github(note: str = ""):
 def get_conn():
     return sqlite3.connect(DB_PATH, check_same_thread=False)
 
-def init_db_with_defaults():
-    conn = get_conn()
-    cur = conn.cursor()
-    # Stocks table
-    cur.execute("""
+# Seed universe, inserted only when the stocks table is first created
+DEFAULT_STOCKS = [
+    # --- US ---
+    ("STT","State Street Corporation","US","USD"),
+    ("PFE","Pfizer Inc.","US","USD"),
+    ("SBUX","Starbucks Corporation","US","USD"),
+    ("PEP","PepsiCo, Inc.","US","USD"),
+    ("ORCL","Oracle Corporation","US","USD"),
+    ("NVS","Novartis AG","US","USD"),
+    ("META","Meta Platforms, Inc.","US","USD"),
+    ("MSFT","Microsoft Corporation","US","USD"),
+    ("MRK","Merck & Co., Inc.","US","USD"),
+    ("JNJ","Johnson & Johnson","US","USD"),
+    ("INTC","Intel Corporation","US","USD"),
+    ("ICON","Icon Energy Corp.","US","USD"),
+    ("HPQ","HP Inc.","US","USD"),
+    ("GE","GE Aerospace","US","USD"),
+    ("LLY","Eli Lilly and Company","US","USD"),
+    ("EBAY","eBay Inc.","US","USD"),
+    ("COKE","Coca-Cola Consolidated, Inc.","US","USD"),
+    ("BSX","Boston Scientific Corporation","US","USD"),
+    ("AAPL","Apple Inc.","US","USD"),
+    ("AMGN","Amgen Inc.","US","USD"),
+    ("ADI","Analog Devices, Inc.","US","USD"),
+    ("ABBV","AbbVie Inc.","US","USD"),
+    ("GOOG","Alphabet Inc.","US","USD"),
+    ("ABT","Abbott Laboratories","US","USD"),
+    ("CRH","CRH plc","US","USD"),
+    ("SW","Smurfit Westrock Plc","US","USD"),
+    ("AER","AerCap Holdings","US","USD"),
+    ("FLUT","Flutter Entertainment plc","US","USD"),
+    # --- Europe (non-UK, non-Ireland) ---
+    ("HEIA.AS","Heineken N.V.","Europe","EUR"),
+    ("BSN.F","Danone S.A.","Europe","EUR"),
+    ("BKT.MC","Bankinter","Europe","EUR"),
+    ("IBE.MC","Iberdrola S.A.","Europe","EUR"),
+    ("ORSTED.CO","Orsted A/S","Europe","DKK"),
+    ("ROG.SW","Roche Holding AG","Europe","CHF"),
+    ("SAN.PA","Sanofi","Europe","EUR"),
+    # --- UK ---
+    ("VOD.L","Vodafone Group","UK","GBp"),
+    ("DCC.L","DCC plc","UK","GBp"),
+    ("DGE.L","Diageo plc","UK","GBp"),
+    ("GNC.L","Greencore Group plc","UK","GBp"),
+    ("GFTU.L","Grafton Group plc","UK","GBp"),
+    ("HVO.L","hVIVO plc","UK","GBp"),
+    ("POLB.L","Poolbeg Pharma PLC","UK","GBp"),
+    ("TSCO.L","Tesco plc","UK","GBp"),
+    ("BRBY.L","Burberry","UK","GBp"),
+    ("SSPG.L","SSP Group","UK","GBp"),
+    ("ABF.L","Associated British Foods","UK","GBp"),
+    ("GWMO.L","Great Western Mining Corp","UK","GBp"),
+    # --- Ireland ---
+    ("GVR.IR","Glenveagh Properties PLC","Ireland","EUR"),
+    ("UPR.IR","Uniphar plc","Ireland","EUR"),
+    ("RYA.IR","Ryanair Holdings plc","Ireland","EUR"),
+    ("PTSB.IR","Permanent TSB Group Holdings plc","Ireland","EUR"),
+    ("OIZ.IR","Origin Enterprises plc","Ireland","EUR"),
+    ("MLC.IR","Malin Corporation plc","Ireland","EUR"),
+    ("KRX.IR","Kingspan Group plc","Ireland","EUR"),
+    ("KRZ.IR","Kerry Group plc","Ireland","EUR"),
+    ("KMR.IR","Kenmare Resources plc","Ireland","EUR"),
+    ("IRES.IR","Irish Residential Properties REIT Plc","Ireland","EUR"),
+    ("IR5B.IR","Irish Continental Group plc","Ireland","EUR"),
+    ("HSW.IR","Hostelworld Group plc","Ireland","EUR"),
+    ("GRP.IR","Greencoat Renewables","Ireland","EUR"),
+    ("GL9.IR","Glanbia plc","Ireland","EUR"),
+    ("EG7.IR","FBD Holdings plc","Ireland","EUR"),
+    ("DQ7A.IR","Donegal Investment Group plc","Ireland","EUR"),
+    ("DHG.IR","Dalata Hotel Group plc","Ireland","EUR"),
+    ("C5H.IR","Cairn Homes plc","Ireland","EUR"),
+    ("A5G.IR","AIB Group plc","Ireland","EUR"),
+    ("BIRG.IR","Bank of Ireland Group plc","Ireland","EUR"),
+    ("YZA.IR","Arytza","Ireland","EUR"),
+]
+
+# Ordered schema migrations: (version, statements). Each runs once per DB file
+# and is recorded in schema_version; add new steps at the end, never edit old ones.
+SCHEMA_MIGRATIONS = [
+    (1, [
+        """
         CREATE TABLE IF NOT EXISTS stocks (
             ticker TEXT PRIMARY KEY,
             name   TEXT NOT NULL,
             region TEXT NOT NULL,   -- Ireland | UK | Europe | US
             currency TEXT NOT NULL  -- EUR | GBp | USD | DKK | CHF
         )
-    """)
-    # Manual YTD baselines (one per ticker+year)
-    cur.execute("""
+        """,
+        # Manual YTD baselines (one per ticker+year)
+        """
         CREATE TABLE IF NOT EXISTS reference_prices (
             ticker TEXT NOT NULL,
             year   INTEGER NOT NULL,
@@ -230,89 +478,45 @@ def init_db_with_defaults():
             notes  TEXT,
             PRIMARY KEY (ticker, year)
         )
-    """)
-
-    # Seed defaults WITHOUT overwriting user entries
-    defaults = [
-        # --- US ---
-        ("STT","State Street Corporation","US","USD"),
-        ("PFE","Pfizer Inc.","US","USD"),
-        ("SBUX","Starbucks Corporation","US","USD"),
-        ("PEP","PepsiCo, Inc.","US","USD"),
-        ("ORCL","Oracle Corporation","US","USD"),
-        ("NVS","Novartis AG","US","USD"),
-        ("META","Meta Platforms, Inc.","US","USD"),
-        ("MSFT","Microsoft Corporation","US","USD"),
-        ("MRK","Merck & Co., Inc.","US","USD"),
-        ("JNJ","Johnson & Johnson","US","USD"),
-        ("INTC","Intel Corporation","US","USD"),
-        ("ICON","Icon Energy Corp.","US","USD"),
-        ("HPQ","HP Inc.","US","USD"),
-        ("GE","GE Aerospace","US","USD"),
-        ("LLY","Eli Lilly and Company","US","USD"),
-        ("EBAY","eBay Inc.","US","USD"),
-        ("COKE","Coca-Cola Consolidated, Inc.","US","USD"),
-        ("BSX","Boston Scientific Corporation","US","USD"),
-        ("AAPL","Apple Inc.","US","USD"),
-        ("AMGN","Amgen Inc.","US","USD"),
-        ("ADI","Analog Devices, Inc.","US","USD"),
-        ("ABBV","AbbVie Inc.","US","USD"),
-        ("GOOG","Alphabet Inc.","US","USD"),
-        ("ABT","Abbott Laboratories","US","USD"),
-        ("CRH","CRH plc","US","USD"),
-        ("SW","Smurfit Westrock Plc","US","USD"),
-        ("AER","AerCap Holdings","US","USD"),
-        ("FLUT","Flutter Entertainment plc","US","USD"),
-        # --- Europe (non-UK, non-Ireland) ---
-        ("HEIA.AS","Heineken N.V.","Europe","EUR"),
-        ("BSN.F","Danone S.A.","Europe","EUR"),
-        ("BKT.MC","Bankinter","Europe","EUR"),
-        ("IBE.MC","Iberdrola S.A.","Europe","EUR"),
-        ("ORSTED.CO","Orsted A/S","Europe","DKK"),
-        ("ROG.SW","Roche Holding AG","Europe","CHF"),
-        ("SAN.PA","Sanofi","Europe","EUR"),
-        # --- UK ---
-        ("VOD.L","Vodafone Group","UK","GBp"),
-        ("DCC.L","DCC plc","UK","GBp"),
-        ("DGE.L","Diageo plc","UK","GBp"),
-        ("GNC.L","Greencore Group plc","UK","GBp"),
-        ("GFTU.L","Grafton Group plc","UK","GBp"),
-        ("HVO.L","hVIVO plc","UK","GBp"),
-        ("POLB.L","Poolbeg Pharma PLC","UK","GBp"),
-        ("TSCO.L","Tesco plc","UK","GBp"),
-        ("BRBY.L","Burberry","UK","GBp"),
-        ("SSPG.L","SSP Group","UK","GBp"),
-        ("ABF.L","Associated British Foods","UK","GBp"),
-        ("GWMO.L","Great Western Mining Corp","UK","GBp"),
-        # --- Ireland ---
-        ("GVR.IR","Glenveagh Properties PLC","Ireland","EUR"),
-        ("UPR.IR","Uniphar plc","Ireland","EUR"),
-        ("RYA.IR","Ryanair Holdings plc","Ireland","EUR"),
-        ("PTSB.IR","Permanent TSB Group Holdings plc","Ireland","EUR"),
-        ("OIZ.IR","Origin Enterprises plc","Ireland","EUR"),
-        ("MLC.IR","Malin Corporation plc","Ireland","EUR"),
-        ("KRX.IR","Kingspan Group plc","Ireland","EUR"),
-        ("KRZ.IR","Kerry Group plc","Ireland","EUR"),
-        ("KMR.IR","Kenmare Resources plc","Ireland","EUR"),
-        ("IRES.IR","Irish Residential Properties REIT Plc","Ireland","EUR"),
-        ("IR5B.IR","Irish Continental Group plc","Ireland","EUR"),
-        ("HSW.IR","Hostelworld Group plc","Ireland","EUR"),
-        ("GRP.IR","Greencoat Renewables","Ireland","EUR"),
-        ("GL9.IR","Glanbia plc","Ireland","EUR"),
-        ("EG7.IR","FBD Holdings plc","Ireland","EUR"),
-        ("DQ7A.IR","Donegal Investment Group plc","Ireland","EUR"),
-        ("DHG.IR","Dalata Hotel Group plc","Ireland","EUR"),
-        ("C5H.IR","Cairn Homes plc","Ireland","EUR"),
-        ("A5G.IR","AIB Group plc","Ireland","EUR"),
-        ("BIRG.IR","Bank of Ireland Group plc","Ireland","EUR"),
-        ("YZA.IR","Arytza","Ireland","EUR"),
-    ]
-    cur.executemany(
-        "INSERT OR IGNORE INTO stocks (ticker,name,region,currency) VALUES (?,?,?,?)",
-        defaults
-    )
-    conn.commit()
-    conn.close()
+        """,
+    ]),
+    (2, [
+        "CREATE INDEX IF NOT EXISTS idx_reference_prices_year ON reference_prices(year)",
+        "CREATE INDEX IF NOT EXISTS idx_stocks_region ON stocks(region)",
+    ]),
+]
+
+def migrate_db(conn) -> dict:
+    """Bring the DB to the latest schema version; seed defaults only if stocks is new."""
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, applied_at TEXT NOT NULL)")
+    current = cur.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] or 0
+    had_stocks = cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='stocks'").fetchone() is not None
+    applied = []
+    for version, statements in SCHEMA_MIGRATIONS:
+        if version <= current:
+            continue
+        for sql in statements:
+            cur.execute(sql)
+        cur.execute("INSERT INTO schema_version (version, applied_at) VALUES (?,?)",
+                    (version, datetime.now(timezone.utc).isoformat(timespec="seconds")))
+        conn.commit()
+        applied.append(version)
+    seeded = False
+    if not had_stocks:
+        cur.executemany("INSERT OR IGNORE INTO stocks (ticker,name,region,currency) VALUES (?,?,?,?)", DEFAULT_STOCKS)
+        conn.commit()
+        seeded = True
+    return {"version": max([current] + applied), "applied": applied, "seeded": seeded}
+
+@st.cache_resource
+def init_db() -> dict:
+    """Schema setup once per process (not on every rerun)."""
+    conn = get_conn()
+    try:
+        return migrate_db(conn)
+    finally:
+        conn.close()
 
 def db_all_stocks():
     conn = get_conn()
@@ -328,6 +532,15 @@ def db_add_stock(ticker, name, region, currency):
     conn.commit()
     conn.close()
 
+def db_add_stocks_bulk(records):
+    """records: iterable of (ticker, name, region, currency); one transaction."""
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.executemany("INSERT OR REPLACE INTO stocks (ticker,name,region,currency) VALUES (?,?,?,?)",
+                    [(t.strip(), n.strip(), r, c) for t, n, r, c in records])
+    conn.commit()
+    conn.close()
+
 def db_remove_stocks(tickers):
     if not tickers:
         return
@@ -368,6 +581,18 @@ def db_all_references(year: Optional[int] = None) -> pd.DataFrame:
     conn.close()
     return df
 
+def db_set_references_bulk(records):
+    """records: iterable of (ticker, year, price, date_iso, series, notes); one transaction."""
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.executemany("""
+        INSERT INTO reference_prices (ticker,year,price,date,series,notes)
+        VALUES (?,?,?,?,?,?)
+        ON CONFLICT(ticker,year) DO UPDATE SET price=excluded.price,date=excluded.date,series=excluded.series,notes=excluded.notes
+    """, [(t.strip(), int(y), float(p), (d or None), (s or None), (n or None)) for t, y, p, d, s, n in records])
+    conn.commit()
+    conn.close()
+
 def db_delete_references(keys):
     if not keys:
         return
@@ -392,6 +617,8 @@ def currency_symbol(cur: str) -> str:
 def _col(use_price_return: bool) -> str:
     return "Close" if use_price_return else "Adj Close"
 
+TR_SUFFIX = " (TR)"  # a Run stores total-return Price/5D/YTD under these suffixed names
+
 def _session_dates_index(df: pd.DataFrame) -> np.ndarray:
     idx = pd.to_datetime(df.index)
     return np.array([d.date() for d in idx], dtype=object)
@@ -429,215 +656,2269 @@ def close_n_trading_days_ago_by_pos(df: pd.DataFrame, pos: int, n: int, use_pric
         return None
 
 # -----------------------------
-# Yahoo chart endpoint for exact YTD + 5D (resilient fetch)
+# Yahoo host health (circuit breaker) + per-run fetch deadline
 # -----------------------------
-def _http_get_json(url: str, params: dict, timeout: float = 10.0) -> Optional[dict]:
-    headers = {"User-Agent": "Mozilla/5.0"}
-    try:
-        if _HTTP_LIB == "requests":
-            r = requests.get(url, params=params, headers=headers, timeout=timeout)
-            r.raise_for_status()
-            return r.json()
-        else:
-            full = f"{url}?{urllib.parse.urlencode(params)}"
-            req = urllib.request.Request(full, headers=headers)
-            with urllib.request.urlopen(req, timeout=timeout) as resp:
-                return json.loads(resp.read().decode("utf-8"))
-    except Exception:
+YAHOO_CHART_HOSTS = ["query1.finance.yahoo.com", "query2.finance.yahoo.com"]
+CIRCUIT_FAIL_THRESHOLD = 3     # consecutive failures before a host's circuit opens
+CIRCUIT_COOLDOWN_S = 60.0      # how long an open circuit rejects calls before a probe
+FETCH_DEADLINE_DEFAULT_S = 90  # overall fetch budget for one Run
+
+# --- Per-run fetch deadline (script globals are reset on every rerun) ---
+_FETCH_DEADLINE = None  # time.monotonic() value, or None = no deadline
+
+def set_fetch_deadline(seconds: Optional[float]):
+    global _FETCH_DEADLINE
+    _FETCH_DEADLINE = (time.monotonic() + float(seconds)) if seconds else None
+
+def fetch_time_left() -> Optional[float]:
+    if _FETCH_DEADLINE is None:
         return None
+    return max(0.0, _FETCH_DEADLINE - time.monotonic())
+
+def fetch_deadline_passed() -> bool:
+    left = fetch_time_left()
+    return left is not None and left <= 0.0
+
+def _bounded_timeout(timeout: float) -> float:
+    left = fetch_time_left()
+    return timeout if left is None else max(0.5, min(timeout, left))
+
+# --- Host health / circuit breaker (shared by all sessions in this process) ---
+@st.cache_resource
+def _yahoo_host_health() -> dict:
+    return {
+        "lock": threading.Lock(),
+        "hosts": {h: {"fails": 0, "open_until": 0.0, "last_ok": 0.0, "ok": 0, "err": 0} for h in YAHOO_CHART_HOSTS},
+    }
+
+def _host_record(host: str, ok: bool):
+    health = _yahoo_host_health()
+    with health["lock"]:
+        h = health["hosts"].setdefault(host, {"fails": 0, "open_until": 0.0, "last_ok": 0.0, "ok": 0, "err": 0})
+        now = time.monotonic()
+        if ok:
+            h.update(fails=0, open_until=0.0, last_ok=now)
+            h["ok"] += 1
+        else:
+            h["fails"] += 1
+            h["err"] += 1
+            if h["fails"] >= CIRCUIT_FAIL_THRESHOLD:
+                h["open_until"] = now + CIRCUIT_COOLDOWN_S
+
+def yahoo_hosts_in_order() -> list:
+    """Closed-circuit hosts, most recently successful first. Empty if every circuit is open."""
+    health = _yahoo_host_health()
+    now = time.monotonic()
+    with health["lock"]:
+        usable = [(name, h) for name, h in health["hosts"].items() if h["open_until"] <= now]
+    usable.sort(key=lambda kv: kv[1]["last_ok"], reverse=True)
+    return [name for name, _ in usable]
+
+def yahoo_host_status() -> pd.DataFrame:
+    health = _yahoo_host_health()
+    now = time.monotonic()
+    with health["lock"]:
+        rows = [{
+            "host": name,
+            "circuit": "open" if h["open_until"] > now else "closed",
+            "consecutive_fails": h["fails"],
+            "ok": h["ok"],
+            "errors": h["err"],
+        } for name, h in health["hosts"].items()]
+    return pd.DataFrame(rows)
+
+# -----------------------------
+# Outbound rate limiter (token bucket per host, adaptive on 429)
+# -----------------------------
+# Every live request takes a token from its host's bucket first ("yfinance"
+# stands for the library's own requests). A 429 halves the host's rate and
+# honours Retry-After; each success adds a little back (AIMD), so the rate
+# settles just under what Yahoo tolerates. Overrides: secrets RATE_LIMIT_PER_S.
+RATE_DEFAULT_PER_S = 8.0    # starting (and maximum) sustained requests/s per host
+RATE_BURST = 8.0            # bucket capacity
+RATE_MIN_PER_S = 0.25
+RATE_DECREASE = 0.5         # rate multiplier on 429
+RATE_INCREASE_PER_OK = 0.05 # requests/s added back per success
+RATE_MAX_WAIT_S = 30.0      # never wait longer than this for one token
+YF_BUCKET = "yfinance"
+HTTP_THROTTLED = 0          # status of a request the limiter did not send
+
+@st.cache_resource
+def _rate_limiter():
+    return {"lock": threading.Lock(), "buckets": {}}
+
+def _rate_bucket(state: dict, host: str) -> dict:
+    b = state["buckets"].get(host)
+    if b is None:
+        ceiling = float(st.secrets.get("RATE_LIMIT_PER_S", RATE_DEFAULT_PER_S))
+        b = state["buckets"][host] = {
+            "rate": ceiling, "ceiling": ceiling, "tokens": RATE_BURST, "updated": time.monotonic(),
+            "blocked_until": 0.0, "calls": 0, "waits": 0, "waited_s": 0.0, "refused": 0, "429s": 0,
+        }
+    return b
 
-def _yahoo_chart_series(symbol: str, max_range: str = "3mo", interval: str = "1d"):
+def rate_acquire(host: str) -> bool:
     """
-    Return list of (date, close) using Yahoo chart API.
-    Tries query1 then query2, and expands range if needed.
+    Block until host's bucket yields a token, bounded by RATE_MAX_WAIT_S and the
+    fetch deadline. False means throttled: the caller must not send the request
+    (defer it, or leave the ticker pending for the retry queue).
     """
-    def _fetch(base_host: str, rng: str):
-        url = f"https://{base_host}/v8/finance/chart/{symbol}"
-        params = {
-            "range": rng,
-            "interval": interval,
-            "includePrePost": "false",
-            "events": "div,splits"
-        }
-        return _http_get_json(url, params)
+    state = _rate_limiter()
+    waited = 0.0
+    while True:
+        with state["lock"]:
+            b = _rate_bucket(state, host)
+            now = time.monotonic()
+            b["tokens"] = min(RATE_BURST, b["tokens"] + (now - b["updated"]) * b["rate"])
+            b["updated"] = now
+            if now >= b["blocked_until"] and b["tokens"] >= 1.0:
+                b["tokens"] -= 1.0
+                b["calls"] += 1
+                if waited:
+                    b["waits"] += 1
+                    b["waited_s"] += waited
+                return True
+            wait = max(b["blocked_until"] - now, (1.0 - b["tokens"]) / b["rate"])
+            budget = _bounded_timeout(RATE_MAX_WAIT_S) - waited
+            if wait > budget:  # no token within budget: refuse rather than send unthrottled
+                b["refused"] += 1
+                return False
+        time.sleep(wait)
+        waited += wait
+
+def rate_feedback(host: str, status: Optional[int], retry_after: Optional[str] = None):
+    """Adapt host's rate: multiplicative decrease (and Retry-After pause) on 429, additive increase on success."""
+    state = _rate_limiter()
+    with state["lock"]:
+        b = _rate_bucket(state, host)
+        if status == 429:
+            b["429s"] += 1
+            b["rate"] = max(RATE_MIN_PER_S, b["rate"] * RATE_DECREASE)
+            b["tokens"] = min(b["tokens"], 0.0)
+            try:
+                pause = float(retry_after) if retry_after else 1.0 / b["rate"]
+            except ValueError:
+                pause = 1.0 / b["rate"]
+            b["blocked_until"] = max(b["blocked_until"], time.monotonic() + min(pause, RATE_MAX_WAIT_S))
+        elif status is not None and 200 <= status < 300:
+            b["rate"] = min(b["ceiling"], b["rate"] + RATE_INCREASE_PER_OK)
+
+def _yf_rate_limited(exc: Optional[BaseException]) -> bool:
+    """
+    Whether a yfinance exception is a rate limit: YFRateLimitError, or an HTTP
+    error whose status is 429, anywhere down the cause chain. Never matched
+    on message text (symbols and timestamps can contain "429").
+    """
+    for _ in range(5):
+        if exc is None:
+            return False
+        if YFRateLimitError is not None and isinstance(exc, YFRateLimitError):
+            return True
+        status = getattr(getattr(exc, "response", None), "status_code", None) or getattr(exc, "status_code", None) or getattr(exc, "code", None)
+        if status == 429:
+            return True
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+def rate_limiter_status() -> pd.DataFrame:
+    state = _rate_limiter()
+    now = time.monotonic()
+    with state["lock"]:
+        rows = [{
+            "host": host, "rate/s": round(b["rate"], 2), "ceiling/s": b["ceiling"],
+            "tokens": round(min(RATE_BURST, b["tokens"] + (now - b["updated"]) * b["rate"]), 1),
+            "blocked s": round(max(0.0, b["blocked_until"] - now), 1),
+            "calls": b["calls"], "throttled": b["waits"], "throttled wait s": round(b["waited_s"], 2),
+            "refused": b["refused"], "429s": b["429s"],
+        } for host, b in sorted(state["buckets"].items())]
+    return pd.DataFrame(rows)
 
-    hosts = ["query1.finance.yahoo.com", "query2.finance.yahoo.com"]
-    ranges = [max_range, "6mo"] if max_range != "6mo" else [max_range]
+# -----------------------------
+# Cache backends for fetched bars/quotes (memory | shared SQLite file | Redis)
+# -----------------------------
+# Configure with st.secrets:
+#   CACHE_BACKEND = "memory" (default) | "sqlite" | "redis"
+#   CACHE_SQLITE_PATH = "/shared/volume/fetch_cache.db"
+#   REDIS_URL = "redis://[:password@]host:6379/0"
+# SQLite and Redis let replicas warm each other. Values are pickled, so only
+# point these at storage your replicas trust.
+SHARED_CACHE_MAX_ENTRIES = 5000
+CACHE_SQLITE_DEFAULT_PATH = "fetch_cache.db"
+CACHE_KEY_PREFIX = "markets:fetch:"
 
-    for rng in ranges:
-        for host in hosts:
-            data = _fetch(host, rng)
-            if data and data.get("chart", {}).get("error") is None:
-                try:
-                    result = data["chart"]["result"][0]
-                    meta = result.get("meta", {})
-                    tzname = meta.get("exchangeTimezoneName", "UTC")
-                    tz = ZoneInfo(tzname) if ZoneInfo else None
-
-                    stamps = result.get("timestamp", []) or []
-                    closes = (result.get("indicators", {}).get("quote", [{}])[0].get("close", []) or [])
-                    dcs = []
-                    for t, c in zip(stamps, closes):
-                        if c is None:
-                            continue
-                        dt = datetime.fromtimestamp(t, tz) if tz else datetime.utcfromtimestamp(t)
-                        dcs.append((dt.date(), float(c)))
-                    if dcs:
-                        return dcs, meta
-                except Exception:
-                    pass
-    return None, None
+def _cache_key_str(key: tuple) -> str:
+    return CACHE_KEY_PREFIX + "|".join(str(k) for k in key)
 
-def yahoo_pct_change_n_bars(symbol: str, on_date: date, n_bars: int, use_live_when_today: bool = True) -> Optional[float]:
-    dcs, meta = _yahoo_chart_series(symbol, max_range="3mo", interval="1d")
-    if not dcs:
-        return None
+def _cache_dumps(value) -> bytes:
+    return zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), 3)
 
-    upto = [c for (d, c) in dcs if d <= on_date]
-    if len(upto) < (n_bars + 1):
-        return None
+def _cache_loads(blob: bytes):
+    return pickle.loads(zlib.decompress(blob))
 
-    last_close = upto[-1]
-    if use_live_when_today and on_date == date.today():
-        try:
-            fi = yf.Ticker(symbol).fast_info
-            live = fi.get("last_price") or fi.get("regular_market_price")
-            if live is not None:
-                last_close = float(live)
-        except Exception:
-            pass
+CACHE_FOREVER = None  # ttl for values kept until replaced (the verified bar store)
+_SQLITE_NEVER = 253402300799.0  # 9999-12-31: expires_at for CACHE_FOREVER rows
 
-    base = upto[-(n_bars + 1)]
-    if not base:
+class CacheBackend:
+    """get/set of (key tuple -> value) with a TTL (None = never expires). Backends never raise: errors read as misses."""
+    name = "base"
+
+    def get(self, key: tuple):
+        raise NotImplementedError
+
+    def set(self, key: tuple, value, ttl: Optional[float]):
+        raise NotImplementedError
+
+    def size(self) -> Optional[int]:
         return None
-    return (last_close - base) / base * 100.0
 
-def yahoo_ytd_via_chart(symbol: str, year: int, on_date: date, use_live_when_today: bool = True) -> Optional[float]:
-    url = f"https://query1.finance.yahoo.com/v8/finance/chart/{symbol}"
-    params = {"range": "2y", "interval": "1d", "includePrePost": "false", "events": "div,splits"}
-    data = _http_get_json(url, params)
-    if not data:
-        url = f"https://query2.finance.yahoo.com/v8/finance/chart/{symbol}"
-        data = _http_get_json(url, params)
-        if not data:
-            return None
-    try:
-        result = data["chart"]["result"][0]
-        meta = result.get("meta", {})
-        tzname = meta.get("exchangeTimezoneName", "UTC")
-        tz = ZoneInfo(tzname) if ZoneInfo else None
+class MemoryCacheBackend(CacheBackend):
+    name = "memory"
 
-        stamps = result.get("timestamp", []) or []
-        closes = (result.get("indicators", {}).get("quote", [{}])[0].get("close", []) or [])
-        if not stamps or not closes:
+    def __init__(self, max_entries: int = SHARED_CACHE_MAX_ENTRIES):
+        self._lock = threading.Lock()
+        self._entries = {}   # key -> (expires_at, value)
+        self._max = max_entries
+
+    def get(self, key: tuple):
+        with self._lock:
+            hit = self._entries.get(key)
+        if hit is None or hit[0] <= time.time():
             return None
+        return hit[1]
+
+    def set(self, key: tuple, value, ttl: Optional[float]):
+        now = time.time()
+        with self._lock:
+            if len(self._entries) >= self._max:
+                stale = [k for k, (exp, _) in self._entries.items() if exp <= now]
+                for k in stale or list(self._entries)[: len(self._entries) // 4]:
+                    self._entries.pop(k, None)
+            self._entries[key] = (float("inf") if ttl is None else now + ttl, value)
+
+    def size(self) -> Optional[int]:
+        with self._lock:
+            return len(self._entries)
+
+class SQLiteCacheBackend(CacheBackend):
+    """Cache table in a SQLite file that several replicas can mount (WAL mode)."""
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS fetch_cache (
+                key        TEXT PRIMARY KEY,
+                expires_at REAL NOT NULL,
+                value      BLOB NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS fetch_cache_expires ON fetch_cache(expires_at)")
+        conn.commit()
+        conn.close()
 
-        dcs = []
-        for t, c in zip(stamps, closes):
-            if c is None:
-                continue
-            dt = datetime.fromtimestamp(t, tz) if tz else datetime.utcfromtimestamp(t)
-            dcs.append((dt.date(), float(c)))
-        if not dcs:
+    def _conn(self):
+        return sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+
+    def get(self, key: tuple):
+        try:
+            conn = self._conn()
+            row = conn.execute(
+                "SELECT value FROM fetch_cache WHERE key=? AND expires_at>?",
+                (_cache_key_str(key), time.time()),
+            ).fetchone()
+            conn.close()
+            return _cache_loads(row[0]) if row else None
+        except Exception:
             return None
 
-        jan1 = date(year, 1, 1)
-        prior = [c for d, c in dcs if d < jan1]
-        if not prior:
-            in_year = [c for d, c in dcs if d >= jan1]
-            if not in_year:
-                return None
-            base = in_year[0]
-        else:
-            base = prior[-1]
+    def set(self, key: tuple, value, ttl: Optional[float]):
+        try:
+            now = time.time()
+            conn = self._conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO fetch_cache (key,expires_at,value) VALUES (?,?,?)",
+                (_cache_key_str(key), _SQLITE_NEVER if ttl is None else now + ttl, sqlite3.Binary(_cache_dumps(value))),
+            )
+            conn.execute("DELETE FROM fetch_cache WHERE expires_at<=?", (now,))
+            conn.commit()
+            conn.close()
+        except Exception:
+            pass
 
-        last_vals = [c for d, c in dcs if d <= on_date]
-        if not last_vals:
+    def size(self) -> Optional[int]:
+        try:
+            conn = self._conn()
+            n = conn.execute("SELECT COUNT(*) FROM fetch_cache").fetchone()[0]
+            conn.close()
+            return int(n)
+        except Exception:
             return None
-        last_close = last_vals[-1]
 
-        if use_live_when_today and on_date == date.today():
-            try:
-                fi = yf.Ticker(symbol).fast_info
-                live = fi.get("last_price") or fi.get("regular_market_price")
-                if live is not None:
-                    last_close = float(live)
-            except Exception:
-                pass
+REDIS_BREAKER_S = 30   # after a connection failure, skip Redis this long
 
-        if base == 0:
+class RedisCacheBackend(CacheBackend):
+    """
+    Minimal RESP2 client (GET / SET PX / SCAN) over a plain socket, so any
+    Redis-protocol server works, including a local stand-in for testing.
+    Connects (PING) on construction; after a failure the circuit stays open for
+    REDIS_BREAKER_S, so get/set miss instantly instead of waiting on timeouts.
+    """
+    name = "redis"
+
+    def __init__(self, url: str, timeout: float = 2.0):
+        u = urlparse(url)
+        self.host = u.hostname or "127.0.0.1"
+        self.port = u.port or 6379
+        self.password = unquote(u.password) if u.password else None
+        self.db = int((u.path or "/0").lstrip("/") or 0)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._sock = None
+        self._rfile = None
+        self._down_until = 0.0
+        self._call("PING")  # unreachable: raise, so cache_backend() falls back
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._rfile = self._sock.makefile("rb")
+        if self.password:
+            self._command("AUTH", self.password)
+        if self.db:
+            self._command("SELECT", str(self.db))
+
+    def _close(self):
+        try:
+            if self._sock is not None:
+                self._sock.close()
+        except Exception:
+            pass
+        self._sock = None
+        self._rfile = None
+
+    def _command(self, *args):
+        parts = [b"*%d\r\n" % len(args)]
+        for a in args:
+            b = a if isinstance(a, bytes) else str(a).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(b), b))
+        self._sock.sendall(b"".join(parts))
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self._rfile.readline()
+        if not line:
+            raise ConnectionError("redis connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode("utf-8")
+        if kind == b"-":
+            raise RuntimeError(rest.decode("utf-8", errors="replace"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            n = int(rest)
+            if n < 0:
+                return None
+            data = self._rfile.read(n + 2)
+            return data[:-2]
+        if kind == b"*":
+            n = int(rest)
+            return None if n < 0 else [self._read_reply() for _ in range(n)]
+        raise RuntimeError(f"bad redis reply: {line[:40]!r}")
+
+    def _call(self, *args):
+        with self._lock:
+            if time.monotonic() < self._down_until:
+                raise ConnectionError("redis circuit open")
+            while True:
+                fresh = self._sock is None
+                try:
+                    if fresh:
+                        self._connect()
+                    return self._command(*args)
+                except (OSError, ConnectionError):
+                    self._close()
+                    if fresh:  # a stale socket gets one reconnect; a failed connect opens the circuit
+                        self._down_until = time.monotonic() + REDIS_BREAKER_S
+                        raise
+
+    def get(self, key: tuple):
+        try:
+            blob = self._call("GET", _cache_key_str(key))
+            return _cache_loads(blob) if blob else None
+        except Exception:
             return None
-        return (last_close - base) / base * 100.0
-    except Exception:
-        return None
 
-# -----------------------------
-# OFFICIAL EXCHANGE CALENDAR helpers (Option B)
-# -----------------------------
-CAL_BY_SUFFIX = {
-    "IR": "XDUB",
-    "PA": "XPAR",
-    "AS": "XAMS",
-    "BR": "XBRU",
-    "LS": "XLIS",
-    "L":  "XLON",
-    "MC": "XMAD",
-    "CO": "XCSE",
-    "SW": "XSWX",
-    "DE": "XETR",
-    "F":  "XFRA",
-    "MI": "XMIL",
-}
-def _suffix(sym: str) -> str:
-    return sym.split(".")[-1].upper() if "." in sym else ""
-def ticker_calendar_code(ticker: str) -> Optional[str]:
-    return CAL_BY_SUFFIX.get(_suffix(ticker))
-def official_prev_year_last_session(ticker: str, year: int) -> Optional[date]:
-    if not _HAS_XCALS:
-        return None
-    cal_code = ticker_calendar_code(ticker)
-    if not cal_code:
-        return None
-    try:
-        cal = xcals.get_calendar(cal_code)
-        sched = cal.schedule(start=f"{year-1}-12-01", end=f"{year}-01-10")
-        idx = sched.index
-        if len(idx) == 0:
+    def set(self, key: tuple, value, ttl: Optional[float]):
+        try:
+            expiry = () if ttl is None else ("PX", str(max(1, int(ttl * 1000))))
+            self._call("SET", _cache_key_str(key), _cache_dumps(value), *expiry)
+        except Exception:
+            pass
+
+    def size(self) -> Optional[int]:
+        """This app's keys only (the database may be shared)."""
+        try:
+            cursor, n = "0", 0
+            while True:
+                cursor, keys = self._call("SCAN", cursor, "MATCH", CACHE_KEY_PREFIX + "*", "COUNT", "1000")
+                cursor = cursor.decode() if isinstance(cursor, bytes) else str(cursor)
+                n += len(keys)
+                if cursor == "0":
+                    return n
+        except Exception:
             return None
-        prev = idx[idx.date < date(year, 1, 1)]
-        return prev[-1].date() if len(prev) else None
-    except Exception:
-        return None
-def baseline_from_hist_on_or_before(hist: pd.DataFrame, session_date: date, use_price_return: bool) -> Optional[float]:
-    if hist is None or hist.empty:
-        return None
-    dates = _session_dates_index(hist)
-    mask = dates <= session_date
-    if not mask.any():
-        return None
-    pos = np.where(mask)[0][-1]
+
+@st.cache_resource
+def cache_backend() -> CacheBackend:
+    kind = str(st.secrets.get("CACHE_BACKEND", "memory")).strip().lower()
     try:
-        col_name = _col(use_price_return)
-        value = hist.iloc[pos][col_name]
-        if isinstance(value, pd.Series):
-            value = value.iloc[0]
-        return float(value)
+        if kind == "sqlite":
+            return SQLiteCacheBackend(st.secrets.get("CACHE_SQLITE_PATH", CACHE_SQLITE_DEFAULT_PATH))
+        if kind == "redis":
+            return RedisCacheBackend(st.secrets.get("REDIS_URL", "redis://127.0.0.1:6379/0"))
     except Exception:
-        return None
+        pass  # unreachable shared store: fall back to per-process memory
+    return MemoryCacheBackend()
 
 # -----------------------------
-# Streamlit UI
+# Process-wide shared fetch cache (single-flight)
 # -----------------------------
-st.set_page_config(page_title="Stock Dashboard", layout="wide")
-st.title("📊 Stock Dashboard")
-st.caption("YTD can use official exchange calendars (Europe) or Yahoo’s chart feed. Manual baselines override when provided. Data persisted to your GitHub repo.")
-
-# Debug toggle + helper
-DEBUG_MODE = st.sidebar.toggle("Show debug info", value=False)
+TTL_SESSION_CLOSED_S = 6 * 3600
+TTL_SESSION_OPEN_S = 60
+TTL_QUOTE_OPEN_S = 15
+
+@st.cache_resource
+def _shared_fetch_cache() -> dict:
+    return {
+        "lock": threading.Lock(),
+        "inflight": {},   # key -> {"event": Event, "value": ...}
+        "stats": {"hits": 0, "misses": 0, "coalesced": 0},
+    }
+
+def _is_empty_result(value) -> bool:
+    if value is None:
+        return True
+    if isinstance(value, pd.DataFrame):
+        return value.empty
+    return False
+
+def shared_fetch(key: tuple, ttl, loader):
+    """
+    Return the cached value for key, or call loader() once for all concurrent
+    callers asking for the same key. Empty results are shared with waiters but
+    not cached. Cached values are shared across sessions: treat them as read-only.
+    ttl is seconds (None = forever) or a callable deciding it from the loaded value.
+    """
+    cache = _shared_fetch_cache()
+    backend = cache_backend()
+    bypass = cassette_active()  # record/replay must see every call
+    hit = None if bypass else backend.get(key)
+    with cache["lock"]:
+        if hit is not None:
+            cache["stats"]["hits"] += 1
+            return hit
+        flight = cache["inflight"].get(key)
+        leader = flight is None
+        if leader:
+            flight = {"event": threading.Event(), "value": None}
+            cache["inflight"][key] = flight
+            cache["stats"]["misses"] += 1
+        else:
+            cache["stats"]["coalesced"] += 1
+
+    if not leader:
+        flight["event"].wait(timeout=_bounded_timeout(60))
+        return flight["value"]
+
+    value = None
+    try:
+        value = loader()
+        return value
+    finally:
+        if not bypass and not _is_empty_result(value):
+            backend.set(key, value, ttl(value) if callable(ttl) else ttl)
+        with cache["lock"]:
+            cache["inflight"].pop(key, None)
+        flight["value"] = value
+        flight["event"].set()
+
+def shared_cache_stats() -> dict:
+    cache = _shared_fetch_cache()
+    backend = cache_backend()
+    with cache["lock"]:
+        stats = {**cache["stats"], "inflight": len(cache["inflight"])}
+    return {**stats, "backend": backend.name, "entries": backend.size()}
+
+def _closed_ttl(symbol: str) -> float:
+    """Closed venue: nothing changes until the next open (fallback: TTL_SESSION_CLOSED_S)."""
+    until_open = seconds_until_next_open(symbol)
+    return until_open if until_open else TTL_SESSION_CLOSED_S
+
+def _bars_ttl(symbol: str, last_day: Optional[date] = None) -> Optional[float]:
+    """
+    Freshness of cached bars through last_day, from the venue calendar: final
+    (session closed + grace) bars keep until BAR_BASIS_CHECK_S, since a split
+    or dividend re-bases their adjusted closes; provisional lives
+    TTL_SESSION_OPEN_S while a session is open or settling, else until the next open.
+    """
+    final_to, started_to = bar_horizon(symbol)
+    if last_day is not None and last_day <= final_to:
+        return BAR_BASIS_CHECK_S
+    if final_to >= started_to:  # every started session is final: nothing moves before the next open
+        return _closed_ttl(symbol)
+    return TTL_SESSION_OPEN_S
+
+def _history_key(ticker: str, start_d: date, end_d: date) -> tuple:
+    return ("history", ticker, start_d, end_d)
+
+def yf_history(ticker: str, start, end) -> pd.DataFrame:
+    """yfinance daily bars [start, end) through the shared cache (empty if throttled or failed)."""
+    start_d = pd.to_datetime(start).date()
+    end_d = pd.to_datetime(end).date()
+
+    def _download():
+        if not rate_acquire(YF_BUCKET):
+            return pd.DataFrame()
+        try:
+            # Ticker.history with raise_errors surfaces 429s as exceptions
+            # (yf.download only logs them into a shared, unlocked dict)
+            hist = yf.Ticker(ticker).history(
+                start=start_d, end=end_d, auto_adjust=False, actions=False,
+                timeout=_bounded_timeout(10), raise_errors=True,
+            )
+        except Exception as e:
+            rate_feedback(YF_BUCKET, 429 if _yf_rate_limited(e) else None)
+            return pd.DataFrame()
+        rate_feedback(YF_BUCKET, 200)
+        if getattr(hist.index, "tz", None) is not None:
+            hist.index = hist.index.tz_localize(None)
+        return hist
+
+    def _load():
+        return cassette_call(("yf.download", ticker, start_d, end_d), _download, pd.DataFrame())
+
+    hist = shared_fetch(_history_key(ticker, start_d, end_d), _bars_ttl(ticker, end_d - timedelta(days=1)), _load)
+    return hist if hist is not None else pd.DataFrame()
+
+def live_last_price(symbol: str) -> Optional[float]:
+    """Latest traded price from yfinance fast_info, shared across sessions."""
+    def _live():
+        if not rate_acquire(YF_BUCKET):
+            return None
+        try:
+            fi = yf.Ticker(symbol).fast_info
+            live = fi.get("last_price") or fi.get("regular_market_price")
+            rate_feedback(YF_BUCKET, 200)
+            return float(live) if live is not None else None
+        except Exception as e:
+            rate_feedback(YF_BUCKET, 429 if _yf_rate_limited(e) else None)
+            return None
+
+    def _load():
+        return cassette_call(("yf.fast_info", symbol), _live)
+
+    ttl = _closed_ttl(symbol) if session_closed_now(symbol) else TTL_QUOTE_OPEN_S
+    return shared_fetch(("quote", symbol), ttl, _load)
+
+# -----------------------------
+# Bar store + minimal-window fetch planner
+# -----------------------------
+# Per ticker the backend holds {"bars": DataFrame, "covered": [(start, end), ...]}
+# where covered ranges only contain final bars (session closed). A Run asks
+# for the few windows its metrics need; only the uncovered parts are fetched.
+# Final is not immutable for adjusted columns: see fetch_bars' basis check.
+BAR_STORE_TTL_S = CACHE_FOREVER  # covered ranges are final; provisional bars are refetched by range
+BAR_BASIS_CHECK_S = 12 * 3600    # ...but adjusted closes are re-verified against the provider this often
+ADJ_BASIS_RTOL = 1e-6            # relative Close/Adj Close drift on the same bar that means "re-based"
+PLAN_SLACK_SESSIONS = 2       # extra sessions in case Yahoo skips a bar
+PLAN_MERGE_GAP_DAYS = 5       # windows closer than this are fetched as one
+FINAL_BAR_GRACE = pd.Timedelta(minutes=20)
+_BAR_STORE_LOCK = threading.Lock()
+
+def merge_windows(windows) -> list:
+    """Sort and merge inclusive (start, end) date windows that overlap or nearly touch."""
+    merged = []
+    for s, e in sorted(windows):
+        if merged and s <= merged[-1][1] + timedelta(days=PLAN_MERGE_GAP_DAYS):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], e))
+        else:
+            merged.append((s, e))
+    return merged
+
+def _merge_adjacent(ranges) -> list:
+    """Merge inclusive ranges that overlap or touch (no gap bridging: used for coverage)."""
+    merged = []
+    for s, e in sorted(ranges):
+        if merged and s <= merged[-1][1] + timedelta(days=1):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], e))
+        else:
+            merged.append((s, e))
+    return merged
+
+def _subtract_windows(window, covered) -> list:
+    s, e = window
+    missing = []
+    for cs, ce in sorted(covered):
+        if ce < s or cs > e:
+            continue
+        if cs > s:
+            missing.append((s, cs - timedelta(days=1)))
+        s = max(s, ce + timedelta(days=1))
+        if s > e:
+            break
+    if s <= e:
+        missing.append((s, e))
+    return missing
+
+def bar_horizon(ticker: str):
+    """
+    (final_to, started_to): the last date whose daily bar is final (session
+    closed, plus grace) and the last date that can have any bar at all
+    (session opened). Without a calendar: yesterday / today.
+    """
+    if _HAS_XCALS:
+        try:
+            cal = xcals.get_calendar(venue_calendar_code(ticker))
+            now = pd.Timestamp.now(tz="UTC")
+            sess = cal.date_to_session(pd.Timestamp(now.date()), direction="previous")
+            started = sess if cal.session_open(sess) <= now else cal.previous_session(sess)
+            final = sess if cal.session_close(sess) + FINAL_BAR_GRACE <= now else cal.previous_session(sess)
+            return final.date(), started.date()
+        except Exception:
+            pass
+    return date.today() - timedelta(days=1), date.today()
+
+def final_through(ticker: str) -> date:
+    return bar_horizon(ticker)[0]
+
+def bar_finality(ticker: str, bars: pd.DataFrame) -> pd.Series:
+    """'final' / 'provisional' per bar, by the venue calendar's close times."""
+    final_to = final_through(ticker)
+    return pd.Series(np.where(_session_dates_index(bars) <= final_to, "final", "provisional"), index=bars.index)
+
+def plan_fetch_windows(ticker: str, target_date: date, n_back: int = 5, need_ytd: bool = True,
+                       span_from: Optional[date] = None) -> list:
+    """
+    Minimal inclusive date windows for one ticker: the target bar with the
+    n_back sessions before it, and (for YTD) the previous year's last session.
+    span_from asks for every bar from that date on (longer horizons).
+    Uses the venue calendar; falls back to calendar-day padding without one.
+    """
+    windows = []
+    cal = None
+    if _HAS_XCALS:
+        try:
+            cal = xcals.get_calendar(venue_calendar_code(ticker))
+        except Exception:
+            cal = None
+    if cal is not None:
+        try:
+            t_sess = cal.date_to_session(pd.Timestamp(target_date), direction="previous")
+            first = cal.sessions_window(t_sess, -(n_back + 1 + PLAN_SLACK_SESSIONS))[0]
+            windows.append((first.date(), target_date))
+            if need_ytd:
+                b_sess = cal.date_to_session(pd.Timestamp(date(target_date.year - 1, 12, 31)), direction="previous")
+                b_first = cal.sessions_window(b_sess, -(1 + PLAN_SLACK_SESSIONS))[0]
+                windows.append((b_first.date(), b_sess.date()))
+            if span_from is not None:
+                s_sess = cal.date_to_session(pd.Timestamp(span_from), direction="previous")
+                windows.append((cal.sessions_window(s_sess, -(1 + PLAN_SLACK_SESSIONS))[0].date(), target_date))
+        except Exception:
+            windows = []
+    if not windows:
+        windows.append((target_date - timedelta(days=2 * n_back + 7), target_date))
+        if need_ytd:
+            windows.append((date(target_date.year - 1, 12, 20), date(target_date.year - 1, 12, 31)))
+        if span_from is not None:
+            windows.append((span_from - timedelta(days=7), target_date))
+    return merge_windows(windows)
+
+def _basis_changed(old: pd.DataFrame, new: pd.DataFrame) -> bool:
+    """
+    True if a bar present in both disagrees on Close or Adj Close: the provider
+    re-based its history (split or dividend) since `old` was stored. Pass only
+    bars that were final when stored; a provisional bar moves on its own.
+    """
+    for col in ("Close", "Adj Close"):
+        if col not in old.columns or col not in new.columns:
+            continue
+        a, b = _close_series(old, col), _close_series(new, col)
+        a, b = a[~a.index.duplicated(keep="last")], b[~b.index.duplicated(keep="last")]
+        common = a.index.intersection(b.index)
+        if len(common) and not np.allclose(a[common].to_numpy(), b[common].to_numpy(), rtol=ADJ_BASIS_RTOL, atol=0.0):
+            return True
+    return False
+
+def _basis_anchor(old_dates: np.ndarray, s: date, e: date) -> Optional[date]:
+    """Nearest stored bar date outside [s, e]: a window fetched through it overlaps the store by one bar."""
+    before = old_dates[old_dates < s]
+    if len(before):
+        return max(before)
+    after = old_dates[old_dates > e]
+    return min(after) if len(after) else None
+
+def fetch_bars(ticker: str, windows, _rebased: bool = False) -> pd.DataFrame:
+    """
+    Daily bars covering the given inclusive windows, fetching only what the
+    bar store does not already hold as final. Returns bars within the
+    overall span of the windows, sorted by date.
+
+    Close and Adj Close are adjusted values that the provider re-bases after a
+    split or dividend, so stored bars are never spliced blind: every fetch is
+    stretched to overlap one stored final bar, and the store is re-verified that way
+    at least every BAR_BASIS_CHECK_S. If the overlap disagrees, the ticker's
+    store is dropped and the windows are fetched whole on the current basis.
+    """
+    windows = merge_windows(windows)
+    if not windows:
+        return pd.DataFrame()
+    backend = cache_backend()
+    key = ("bars", ticker)
+    bypass = cassette_active()  # fetch every window so record/replay see the same calls
+    empty_store = {"bars": pd.DataFrame(), "covered": [], "checked_at": time.time()}
+    store = (None if bypass else backend.get(key)) or dict(empty_store)
+    final_to, started_to = bar_horizon(ticker)
+    old_dates = _session_dates_index(store["bars"]) if not store["bars"].empty else np.array([], dtype=object)
+    old_final = old_dates[old_dates <= store.get("final_to", date.min)]  # provisional bars are no basis
+    fetch = []
+    for w in windows:
+        for s, e in _subtract_windows(w, store["covered"]):
+            e = min(e, started_to)  # no bar can exist for a session that has not opened
+            if s <= e:
+                fetch.append((s, e))
+    if not fetch and len(old_final) and time.time() - store.get("checked_at", 0.0) >= BAR_BASIS_CHECK_S:
+        last = max(old_final)
+        fetch.append((last, last))  # re-verify the stored basis on its newest final bar
+    fresh = []
+    for s, e in fetch:
+        anchor = _basis_anchor(old_final, s, e)
+        fs, fe = (min(s, anchor), max(e, anchor)) if anchor is not None else (s, e)
+        part = yf_history(ticker, start=fs, end=fe + timedelta(days=1))
+        fresh.append((fs, fe, part))
+
+    bars = store["bars"]
+    rebased = False
+    if fresh:
+        with _BAR_STORE_LOCK:
+            if not bypass:
+                store = backend.get(key) or store
+            old = store["bars"]
+            got = [p for _, _, p in fresh if p is not None and not p.empty]
+            held = old[_session_dates_index(old) <= store.get("final_to", date.min)] if not old.empty else old
+            rebased = not held.empty and any(_basis_changed(held, p) for p in got)
+            if rebased and not bypass:
+                backend.set(key, dict(empty_store), BAR_STORE_TTL_S)
+            elif not old.empty:  # refetched ranges replace what was stored (provisional bars)
+                old_dates = _session_dates_index(old)
+                stale = np.zeros(len(old), dtype=bool)
+                for s, e, p in fresh:
+                    if p is not None and not p.empty:
+                        stale |= (old_dates >= s) & (old_dates <= e)
+                old = old[~stale]
+            if not rebased:
+                parts = [p for p in [old] + got if not p.empty]
+                bars = pd.concat(parts).sort_index() if parts else pd.DataFrame()
+                if not bars.empty:
+                    bars = bars[~bars.index.duplicated(keep="last")]
+                covered = list(store["covered"])
+                for s, e, p in fresh:
+                    if p is not None and not p.empty and s <= final_to:
+                        covered.append((s, min(e, final_to)))
+                store = {"bars": bars, "covered": _merge_adjacent(covered), "final_to": final_to, "checked_at": time.time()}
+                if not bypass:
+                    backend.set(key, store, BAR_STORE_TTL_S)
+    if rebased:
+        # store dropped: fetch the windows whole on the current basis (once; if the
+        # basis moves again mid-refetch, return nothing and let the retry queue try later)
+        return pd.DataFrame() if _rebased else fetch_bars(ticker, windows, _rebased=True)
+
+    if bars.empty:
+        return bars
+    dates = _session_dates_index(bars)
+    span = (dates >= windows[0][0]) & (dates <= windows[-1][1])
+    return bars[span]
+
+def planned_history(ticker: str, target_date: date, n_back: int = 5, need_ytd: bool = True) -> pd.DataFrame:
+    return fetch_bars(ticker, plan_fetch_windows(ticker, target_date, n_back, need_ytd))
+
+# -----------------------------
+# Extra return horizons (arithmetic over a session x ticker close matrix)
+# -----------------------------
+# When any extra horizon is selected a Run fetches one contiguous span back
+# to the longest anchor, so every horizon is computed from the same bars.
+EXTRA_HORIZONS = ["1M", "3M", "6M", "1Y", "MTD", "QTD"]
+HORIZON_MONTHS = {"1M": 1, "3M": 3, "6M": 6, "1Y": 12}
+
+def horizon_col(label: str) -> str:
+    return f"{label} % Change"
+
+def horizon_span_start(target_date: date) -> date:
+    """Earliest anchor any extra horizon can need (1Y back; covers MTD/QTD)."""
+    return (pd.Timestamp(target_date) - pd.DateOffset(months=max(HORIZON_MONTHS.values()))).date()
+
+def horizon_anchor(label: str, target_date: date, cal_code: Optional[str] = None) -> date:
+    """
+    Date whose close (on or before) is the horizon's base: the same day N
+    months back, or for MTD/QTD the venue's last session before the period.
+    """
+    if label in HORIZON_MONTHS:
+        return (pd.Timestamp(target_date) - pd.DateOffset(months=HORIZON_MONTHS[label])).date()
+    month = target_date.month if label == "MTD" else 3 * ((target_date.month - 1) // 3) + 1
+    day_before = date(target_date.year, month, 1) - timedelta(days=1)
+    if _HAS_XCALS and cal_code:
+        try:
+            cal = xcals.get_calendar(cal_code)
+            return cal.date_to_session(pd.Timestamp(day_before), direction="previous").date()
+        except Exception:
+            pass
+    return day_before
+
+def horizon_returns(closes: pd.DataFrame, prices: pd.Series, target_date: date, cal_codes: dict,
+                    labels=EXTRA_HORIZONS) -> pd.DataFrame:
+    """
+    % change per ticker (rows) and horizon (columns): the ticker's price over
+    its last close on or before each anchor, looked up for all tickers at once.
+    """
+    closes = closes.copy()
+    closes.index = pd.to_datetime(closes.index)
+    filled = closes.sort_index().ffill()
+    values = filled.to_numpy(dtype=float)
+    tickers = list(filled.columns)
+    price = pd.to_numeric(prices.reindex(tickers), errors="coerce").to_numpy(dtype=float)
+    codes = [cal_codes.get(t) for t in tickers]
+    out = pd.DataFrame(index=pd.Index(tickers, name="Ticker"))
+    for label in labels:
+        anchors = {c: horizon_anchor(label, target_date, c) for c in set(codes)}
+        pos = filled.index.searchsorted(pd.to_datetime([anchors[c] for c in codes]), side="right") - 1
+        base = values[np.clip(pos, 0, None), np.arange(len(tickers))] if len(filled) else np.full(len(tickers), np.nan)
+        base = np.where((pos >= 0) & (base != 0), base, np.nan)
+        out[horizon_col(label)] = (price / base - 1.0) * 100.0
+    return out
+
+# -----------------------------
+# Live mode: batched last prices + incremental recompute
+# -----------------------------
+SPARK_BATCH_SIZE = 20       # symbols per spark request
+LIVE_INTERVAL_CHOICES = [5, 10, 15, 30, 60]
+
+def _spark_last_prices(data: Optional[dict]) -> dict:
+    """Parse a /v8/finance/spark payload into {symbol: last price}."""
+    out = {}
+    for res in ((data or {}).get("spark") or {}).get("result") or []:
+        try:
+            sym = res["symbol"]
+            resp = (res.get("response") or [{}])[0]
+            px = (resp.get("meta") or {}).get("regularMarketPrice")
+            if px is None:
+                closes = [c for c in ((resp.get("indicators") or {}).get("quote") or [{}])[0].get("close") or [] if c is not None]
+                px = closes[-1] if closes else None
+            if px is not None:
+                out[sym] = float(px)
+        except Exception:
+            continue
+    return out
+
+def _spark_fetch(symbols: tuple) -> dict:
+    params = {"symbols": ",".join(symbols), "range": "1d", "interval": "5m"}
+    for host in yahoo_hosts_in_order():
+        status, data = _http_get(f"https://{host}/v8/finance/spark", params)
+        if status == HTTP_THROTTLED:
+            continue  # our own limiter, not the host's fault
+        if status is None or status == 429 or status >= 500:
+            _host_record(host, ok=False)
+            continue
+        _host_record(host, ok=True)
+        return _spark_last_prices(data) if 200 <= status < 300 else {}
+    return {}
+
+def batch_last_prices(symbols) -> dict:
+    """
+    {symbol: last price} for many symbols in a handful of spark requests
+    (chunks fetched concurrently, coalesced across sessions). Symbols the
+    batch endpoint misses are left out: callers keep their last values rather
+    than paying one serial quote call per symbol inside a tick.
+    """
+    symbols = sorted(set(symbols))
+    chunks = [tuple(symbols[i:i + SPARK_BATCH_SIZE]) for i in range(0, len(symbols), SPARK_BATCH_SIZE)]
+
+    def _chunk(chunk):
+        return shared_fetch(("spark",) + chunk, TTL_QUOTE_OPEN_S / 3, lambda: _spark_fetch(chunk)) or {}
+
+    prices = {}
+    if chunks:
+        with ThreadPoolExecutor(max_workers=min(8, len(chunks))) as pool:
+            for part in pool.map(_chunk, chunks):
+                prices.update(part)
+    return prices
+
+def live_bases(df: pd.DataFrame, price_col: str, pct_cols) -> pd.DataFrame:
+    """
+    Reference prices implied by a computed row: base = price / (1 + pct/100).
+    Computed once per result; live ticks then only need the new last price.
+    """
+    price = pd.to_numeric(df[price_col], errors="coerce")
+    return pd.DataFrame({c: price / (1.0 + pd.to_numeric(df[c], errors="coerce") / 100.0) for c in pct_cols})
+
+def apply_live_prices(df: pd.DataFrame, bases: pd.DataFrame, prices: dict, price_col: str) -> int:
+    """Update price and % cells in place for rows whose last price moved. Returns rows changed."""
+    new = df["Ticker"].map(prices)
+    changed = new.notna() & (new != df[price_col])
+    if changed.any():
+        df.loc[changed, price_col] = new[changed]
+        for c in bases.columns:
+            df.loc[changed, c] = (new[changed] / bases.loc[changed, c] - 1.0) * 100.0
+    return int(changed.sum())
+
+# -----------------------------
+# Yahoo chart endpoint for exact YTD + 5D (resilient fetch)
+# -----------------------------
+def _http_get(url: str, params: dict, timeout: float = 10.0):
+    """Return (status_code, parsed_json_or_None). status_code is None on network errors/timeouts."""
+    key = ("http", url) + tuple(sorted((params or {}).items()))
+    return cassette_call(key, lambda: _http_get_live(url, params, timeout), (None, None))
+
+def _http_get_raw(url: str, params: dict, timeout: float = 10.0):
+    """Like _http_get, but the body is returned undecoded: (status_code, bytes_or_None)."""
+    key = ("http.raw", url) + tuple(sorted((params or {}).items()))
+    return cassette_call(key, lambda: _http_get_live(url, params, timeout, decode=False), (None, None))
+
+def _http_get_live(url: str, params: dict, timeout: float, decode: bool = True):
+    headers = {"User-Agent": "Mozilla/5.0"}
+    host = urlparse(url).hostname or url
+    if not rate_acquire(host):
+        return HTTP_THROTTLED, None
+    timeout = _bounded_timeout(timeout)
+    try:
+        if _HTTP_LIB == "requests":
+            r = requests.get(url, params=params, headers=headers, timeout=timeout)
+            rate_feedback(host, r.status_code, r.headers.get("Retry-After"))
+            if not decode:
+                return r.status_code, r.content
+            try:
+                data = r.json()
+            except Exception:
+                data = None
+            return r.status_code, data
+        else:
+            full = f"{url}?{urllib.parse.urlencode(params)}"
+            req = urllib.request.Request(full, headers=headers)
+            try:
+                with urllib.request.urlopen(req, timeout=timeout) as resp:
+                    rate_feedback(host, resp.getcode())
+                    body = resp.read()
+                    return resp.getcode(), json.loads(body.decode("utf-8")) if decode else body
+            except urllib.error.HTTPError as e:
+                rate_feedback(host, e.code, e.headers.get("Retry-After") if e.headers else None)
+                return e.code, None
+    except Exception:
+        return None, None
+
+def _http_get_json(url: str, params: dict, timeout: float = 10.0) -> Optional[dict]:
+    status, data = _http_get(url, params, timeout)
+    return data if status is not None and 200 <= status < 300 else None
+
+def _yahoo_chart_get(symbol: str, params: dict, window_end: Optional[date] = None) -> Optional[dict]:
+    """Chart payload for symbol via the shared cache (see _yahoo_chart_fetch)."""
+    key = ("chart", symbol) + tuple(sorted(params.items()))
+
+    def _ttl(payload):
+        # Final only if both the padded window (period2 reaches a day past
+        # window_end) and the newest bar actually returned are final sessions:
+        # for venues east of UTC the pad can pull in a later, provisional bar.
+        if window_end is None:
+            return _bars_ttl(symbol)
+        last_day = max(window_end + timedelta(days=1), _chart_last_day(payload) or window_end)
+        return _bars_ttl(symbol, last_day)
+
+    return shared_fetch(key, _ttl, lambda: _yahoo_chart_fetch(symbol, params))
+
+def _yahoo_chart_get_raw(symbol: str, params: dict, window_end: date) -> Optional[bytes]:
+    """
+    Undecoded chart payload for the process-pool stage (decoded in workers).
+    The newest bar is not known without decoding, so the window counts as
+    final only once every session up to period2 (window_end + 2 days) is.
+    """
+    key = ("chart.raw", symbol) + tuple(sorted(params.items()))
+    return shared_fetch(key, _bars_ttl(symbol, window_end + timedelta(days=2)),
+                        lambda: _yahoo_chart_fetch(symbol, params, raw=True))
+
+def _chart_last_day(data: Optional[dict]) -> Optional[date]:
+    """Session date of the newest timestamp in a chart payload (venue time)."""
+    try:
+        result = data["chart"]["result"][0]
+        stamps = result.get("timestamp") or []
+        if not stamps:
+            return None
+        tzname = result.get("meta", {}).get("exchangeTimezoneName", "UTC")
+        return pd.Timestamp(max(stamps), unit="s", tz="UTC").tz_convert(tzname).date()
+    except Exception:
+        return None
+
+def _yahoo_chart_fetch(symbol: str, params: dict, raw: bool = False):
+    """
+    GET the chart payload for symbol from the healthiest Yahoo host (raw:
+    the undecoded body). Network errors, 429 and 5xx count against the
+    host's circuit; other responses (including 404 for unknown symbols)
+    count as the host being up.
+    """
+    get = _http_get_raw if raw else _http_get
+    for host in yahoo_hosts_in_order():
+        if fetch_deadline_passed():
+            return None
+        status, data = get(f"https://{host}/v8/finance/chart/{symbol}", params)
+        if status == HTTP_THROTTLED:
+            continue  # our own limiter, not the host's fault
+        if status is None or status == 429 or status >= 500:
+            _host_record(host, ok=False)
+            continue
+        _host_record(host, ok=True)
+        return data if 200 <= status < 300 else None
+    return None
+
+def _chart_closes(data: Optional[dict]):
+    """Decode a chart payload into ([(date, close), ...], meta); (None, None) if unusable."""
+    if not data or data.get("chart", {}).get("error") is not None:
+        return None, None
+    try:
+        result = data["chart"]["result"][0]
+        meta = result.get("meta", {})
+        tzname = meta.get("exchangeTimezoneName", "UTC")
+        tz = ZoneInfo(tzname) if ZoneInfo else None
+
+        stamps = result.get("timestamp", []) or []
+        closes = (result.get("indicators", {}).get("quote", [{}])[0].get("close", []) or [])
+        dcs = []
+        for t, c in zip(stamps, closes):
+            if c is None:
+                continue
+            dt = datetime.fromtimestamp(t, tz) if tz else datetime.utcfromtimestamp(t)
+            dcs.append((dt.date(), float(c)))
+        return (dcs, meta) if dcs else (None, None)
+    except Exception:
+        return None, None
+
+def _utc_midnight_ts(d: date) -> int:
+    return int(datetime(d.year, d.month, d.day, tzinfo=timezone.utc).timestamp())
+
+def _yahoo_chart_series(symbol: str, start: date, end: date, interval: str = "1d"):
+    """
+    Return list of (date, close) using Yahoo chart API for the inclusive
+    window [start, end] (padded a day each side for exchange time zones),
+    as a single period1/period2 request.
+    """
+    return _chart_closes(_yahoo_chart_get(symbol, _chart_params(start, end, interval), window_end=end))
+
+def _chart_params(start: date, end: date, interval: str = "1d") -> dict:
+    return {
+        "period1": _utc_midnight_ts(start - timedelta(days=1)),
+        "period2": _utc_midnight_ts(end + timedelta(days=2)),
+        "interval": interval,
+        "includePrePost": "false",
+        "events": "div,splits"
+    }
+
+def _chart_frame(data: Optional[dict]) -> pd.DataFrame:
+    """Decode a chart payload into daily bars (Close, Adj Close) indexed by session date."""
+    days, closes = compute_pool.chart_arrays(data)
+    if not len(days):
+        return pd.DataFrame()
+    return pd.DataFrame(closes, index=pd.to_datetime(days, unit="D"), columns=compute_pool.FLAVOURS)
+
+def yahoo_pct_change_n_bars(symbol: str, on_date: date, n_bars: int, use_live_when_today: bool = True) -> Optional[float]:
+    start, end = plan_fetch_windows(symbol, on_date, n_back=n_bars, need_ytd=False)[-1]
+    dcs, meta = _yahoo_chart_series(symbol, start, end)
+    if not dcs:
+        return None
+
+    upto = [c for (d, c) in dcs if d <= on_date]
+    if len(upto) < (n_bars + 1):
+        return None
+
+    last_close = upto[-1]
+    if use_live_when_today and on_date == date.today():
+        live = live_last_price(symbol)
+        if live is not None:
+            last_close = live
+
+    base = upto[-(n_bars + 1)]
+    if not base:
+        return None
+    return (last_close - base) / base * 100.0
+
+def yahoo_ytd_via_chart(symbol: str, year: int, on_date: date, use_live_when_today: bool = True) -> Optional[float]:
+    """
+    YTD % from chart bars: one small request for the previous year's last
+    sessions and one for the target bar (one total when they are close).
+    Only if no prior-year bar exists (new listing) is the whole year fetched.
+    """
+    windows = merge_windows([
+        (date(year - 1, 12, 15), date(year - 1, 12, 31)),
+        (on_date - timedelta(days=10), on_date),
+    ])
+    dcs = []
+    for start, end in windows:
+        part, _ = _yahoo_chart_series(symbol, start, end)
+        dcs += part or []
+    if not dcs:
+        return None
+    try:
+        jan1 = date(year, 1, 1)
+        prior = [c for d, c in dcs if d < jan1]
+        if not prior:
+            in_year_dcs, _ = _yahoo_chart_series(symbol, jan1, on_date)
+            in_year = [c for d, c in (in_year_dcs or []) if d >= jan1]
+            if not in_year:
+                return None
+            base = in_year[0]
+        else:
+            base = prior[-1]
+
+        last_vals = [c for d, c in dcs if d <= on_date]
+        if not last_vals:
+            return None
+        last_close = last_vals[-1]
+
+        if use_live_when_today and on_date == date.today():
+            live = live_last_price(symbol)
+            if live is not None:
+                last_close = live
+
+        if base == 0:
+            return None
+        return (last_close - base) / base * 100.0
+    except Exception:
+        return None
+
+# -----------------------------
+# Price providers (pluggable sources, per-metric fallback order, latency stats)
+# -----------------------------
+# Metrics: "bars" (daily Close/Adj Close over planned windows), "live" (last
+# traded price), "pct_5d" / "ytd" (source-computed changes, exact Yahoo mode).
+# Order per metric comes from secrets PROVIDER_ORDER (a table of lists);
+# providers that look unhealthy lately are moved to the end of the chain.
+PROVIDER_ORDER_DEFAULT = {
+    "bars": ["yfinance", "yahoo_chart", "local_csv"],
+    "live": ["yfinance", "yahoo_chart"],
+    "pct_5d": ["yahoo_chart"],
+    "ytd": ["yahoo_chart"],
+}
+PROVIDER_STATS_WINDOW = 200     # recent calls per provider+metric used for stats
+PROVIDER_MIN_CALLS = 10         # calls before a provider can be demoted
+PROVIDER_MIN_SUCCESS = 0.5      # demote below this recent success rate...
+PROVIDER_SLOW_P95_S = 8.0       # ...or above this recent p95 latency
+PROVIDER_HEALTH_WINDOW_S = 600  # samples older than this no longer demote (lets a provider recover)
+PRICE_CSV_DIR_DEFAULT = "data/prices"
+
+class PriceProvider:
+    """One price source; metrics it does not serve are skipped, not counted."""
+    name = "base"
+    metrics = frozenset()
+
+    def bars(self, ticker: str, windows) -> Optional[pd.DataFrame]:
+        return None
+
+    def live(self, symbol: str) -> Optional[float]:
+        return None
+
+    def pct_5d(self, ticker: str, on_date: date, use_live: bool) -> Optional[float]:
+        return None
+
+    def ytd(self, ticker: str, year: int, on_date: date, use_live: bool) -> Optional[float]:
+        return None
+
+class YFinanceProvider(PriceProvider):
+    name = "yfinance"
+    metrics = frozenset({"bars", "live"})
+
+    def bars(self, ticker, windows):
+        return fetch_bars(ticker, windows)
+
+    def live(self, symbol):
+        return live_last_price(symbol)
+
+class YahooChartProvider(PriceProvider):
+    name = "yahoo_chart"
+    metrics = frozenset({"bars", "live", "pct_5d", "ytd"})
+
+    def bars(self, ticker, windows):
+        parts = [_chart_frame(_yahoo_chart_get(ticker, _chart_params(s, e), window_end=e)) for s, e in merge_windows(windows)]
+        parts = [p for p in parts if not p.empty]
+        if not parts:
+            return pd.DataFrame()
+        bars = pd.concat(parts).sort_index()
+        return bars[~bars.index.duplicated(keep="last")]
+
+    def live(self, symbol):
+        prices = shared_fetch(("spark", symbol), TTL_QUOTE_OPEN_S / 3, lambda: _spark_fetch((symbol,))) or {}
+        return prices.get(symbol)
+
+    def pct_5d(self, ticker, on_date, use_live):
+        return yahoo_pct_change_n_bars(ticker, on_date, 5, use_live_when_today=use_live)
+
+    def ytd(self, ticker, year, on_date, use_live):
+        return yahoo_ytd_via_chart(ticker, year, on_date, use_live_when_today=use_live)
+
+@st.cache_data(show_spinner=False)
+def _read_price_csv(path: str, mtime: float) -> pd.DataFrame:
+    df = pd.read_csv(path, encoding="utf-8-sig")
+    df.index = pd.to_datetime(df.pop("Date")).dt.normalize()
+    if "Adj Close" not in df.columns:
+        df["Adj Close"] = df["Close"]
+    return df[["Close", "Adj Close"]].sort_index()
+
+class LocalCSVProvider(PriceProvider):
+    """Offline bars from <PRICE_CSV_DIR>/<ticker>.csv (Date, Close[, Adj Close])."""
+    name = "local_csv"
+    metrics = frozenset({"bars"})
+
+    def bars(self, ticker, windows):
+        windows = merge_windows(windows)
+        path = os.path.join(st.secrets.get("PRICE_CSV_DIR", PRICE_CSV_DIR_DEFAULT), f"{ticker}.csv")
+        if not windows or not os.path.exists(path):
+            return None
+        df = _read_price_csv(path, os.path.getmtime(path))
+        dates = _session_dates_index(df)
+        return df[(dates >= windows[0][0]) & (dates <= windows[-1][1])]
+
+PRICE_PROVIDERS = {p.name: p for p in (YFinanceProvider(), YahooChartProvider(), LocalCSVProvider())}
+
+@st.cache_resource
+def _provider_stats():
+    return {"lock": threading.Lock(), "calls": {}}  # (provider, metric) -> {"ok", "fail", "recent"}
+
+def _provider_record(name: str, metric: str, ok: bool, secs: float):
+    stats = _provider_stats()
+    with stats["lock"]:
+        entry = stats["calls"].setdefault(
+            (name, metric), {"ok": 0, "fail": 0, "recent": deque(maxlen=PROVIDER_STATS_WINDOW)}
+        )
+        entry["ok" if ok else "fail"] += 1
+        entry["recent"].append((ok, secs, time.monotonic()))
+
+def _recent_summary(recent) -> tuple:
+    """(success rate, p50 s, p95 s) over recent (ok, secs, at) samples."""
+    if not recent:
+        return None, None, None
+    oks = [ok for ok, _, _ in recent]
+    lat = np.array([secs for _, secs, _ in recent])
+    return sum(oks) / len(oks), float(np.percentile(lat, 50)), float(np.percentile(lat, 95))
+
+def provider_order(metric: str) -> list:
+    configured = dict(st.secrets.get("PROVIDER_ORDER", {}) or {}).get(metric)
+    if isinstance(configured, str):
+        configured = [p.strip() for p in configured.split(",")]
+    order = configured or PROVIDER_ORDER_DEFAULT.get(metric, [])
+    return [p for p in order if p in PRICE_PROVIDERS and metric in PRICE_PROVIDERS[p].metrics]
+
+def provider_chain(metric: str) -> list:
+    """Configured order, with recently failing or slow providers moved last."""
+    stats = _provider_stats()
+
+    def _demoted(name):
+        with stats["lock"]:
+            recent = list(stats["calls"].get((name, metric), {}).get("recent", []))
+        cutoff = time.monotonic() - PROVIDER_HEALTH_WINDOW_S
+        recent = [r for r in recent if r[2] >= cutoff]
+        if len(recent) < PROVIDER_MIN_CALLS:
+            return False
+        rate, _, p95 = _recent_summary(recent)
+        return rate < PROVIDER_MIN_SUCCESS or p95 > PROVIDER_SLOW_P95_S
+
+    return sorted(provider_order(metric), key=_demoted)
+
+def provider_call(metric: str, *args):
+    """First non-empty result along the metric's provider chain: (value, provider name)."""
+    for name in provider_chain(metric):
+        if fetch_deadline_passed():
+            break
+        t0 = time.monotonic()
+        try:
+            value = getattr(PRICE_PROVIDERS[name], metric)(*args)
+        except Exception:
+            value = None
+        ok = not _is_empty_result(value)
+        _provider_record(name, metric, ok, time.monotonic() - t0)
+        if ok:
+            return value, name
+    return None, None
+
+def provider_stats_table() -> pd.DataFrame:
+    stats = _provider_stats()
+    with stats["lock"]:
+        items = [(k, e["ok"], e["fail"], list(e["recent"])) for k, e in stats["calls"].items()]
+    rows = []
+    for (name, metric), ok, fail, recent in sorted(items):
+        rate, p50, p95 = _recent_summary(recent)
+        rows.append({
+            "provider": name, "metric": metric, "calls": ok + fail,
+            "success %": round(100.0 * ok / (ok + fail), 1),
+            "recent success %": round(100.0 * rate, 1) if rate is not None else None,
+            "p50 ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "p95 ms": round(p95 * 1000, 1) if p95 is not None else None,
+        })
+    return pd.DataFrame(rows)
+
+# -----------------------------
+# OFFICIAL EXCHANGE CALENDAR helpers (Option B)
+# -----------------------------
+CAL_BY_SUFFIX = {
+    "IR": "XDUB",
+    "PA": "XPAR",
+    "AS": "XAMS",
+    "BR": "XBRU",
+    "LS": "XLIS",
+    "L":  "XLON",
+    "MC": "XMAD",
+    "CO": "XCSE",
+    "SW": "XSWX",
+    "DE": "XETR",
+    "F":  "XFRA",
+    "MI": "XMIL",
+    "ST": "XSTO",
+    "OL": "XOSL",
+    "HE": "XHEL",
+    "VI": "XWBO",
+    "TO": "XTSE",
+    "HK": "XHKG",
+    "T":  "XTKS",
+    "AX": "XASX",
+}
+INDEX_DEFS = [
+    {"name": "ISEQ All-Share", "ticker": "^ISEQ"},
+    {"name": "FTSE 100",       "ticker": "^FTSE"},
+    {"name": "S&P 500",        "ticker": "^GSPC"},
+    {"name": "DAX",            "ticker": "^GDAXI"},
+]
+CAL_BY_INDEX = {
+    "^ISEQ":  "XDUB",
+    "^FTSE":  "XLON",
+    "^GSPC":  "XNYS",
+    "^GDAXI": "XETR",
+}
+def _suffix(sym: str) -> str:
+    return sym.split(".")[-1].upper() if "." in sym else ""
+def ticker_calendar_code(ticker: str) -> Optional[str]:
+    return CAL_BY_SUFFIX.get(_suffix(ticker))
+def venue_calendar_code(ticker: str) -> str:
+    """Calendar for any symbol we fetch: indices, suffixed listings, else NYSE (US names)."""
+    return CAL_BY_INDEX.get(ticker) or ticker_calendar_code(ticker) or "XNYS"
+def session_closed_now(ticker: str) -> bool:
+    """True if the ticker's venue is not trading right now (US/unmapped names use NYSE)."""
+    if not _HAS_XCALS:
+        return False
+    try:
+        cal = xcals.get_calendar(venue_calendar_code(ticker))
+        return not cal.is_open_on_minute(pd.Timestamp.now(tz="UTC").floor("min"))
+    except Exception:
+        return False
+def seconds_until_next_open(ticker: str) -> Optional[float]:
+    if not _HAS_XCALS:
+        return None
+    try:
+        cal = xcals.get_calendar(venue_calendar_code(ticker))
+        now = pd.Timestamp.now(tz="UTC").floor("min")
+        return max(0.0, (cal.next_open(now) - now).total_seconds())
+    except Exception:
+        return None
+def official_prev_year_last_session(ticker: str, year: int) -> Optional[date]:
+    if not _HAS_XCALS:
+        return None
+    cal_code = ticker_calendar_code(ticker)
+    if not cal_code:
+        return None
+    try:
+        cal = xcals.get_calendar(cal_code)
+        sched = cal.schedule(start=f"{year-1}-12-01", end=f"{year}-01-10")
+        idx = sched.index
+        if len(idx) == 0:
+            return None
+        prev = idx[idx.date < date(year, 1, 1)]
+        return prev[-1].date() if len(prev) else None
+    except Exception:
+        return None
+def baseline_from_hist_on_or_before(hist: pd.DataFrame, session_date: date, use_price_return: bool) -> Optional[float]:
+    if hist is None or hist.empty:
+        return None
+    dates = _session_dates_index(hist)
+    mask = dates <= session_date
+    if not mask.any():
+        return None
+    pos = np.where(mask)[0][-1]
+    try:
+        col_name = _col(use_price_return)
+        value = hist.iloc[pos][col_name]
+        if isinstance(value, pd.Series):
+            value = value.iloc[0]
+        return float(value)
+    except Exception:
+        return None
+
+# -----------------------------
+# Cross-source discrepancy scan (Yahoo chart vs yfinance, whole universe)
+# -----------------------------
+DISCREPANCY_CLOSE_TOL_PCT = 0.5
+
+def _close_series(hist: pd.DataFrame, column: str = "Close") -> pd.Series:
+    """Close (or Adj Close) column of a yf.download frame as a Series indexed by session date."""
+    if hist is None or hist.empty:
+        return pd.Series(dtype=float)
+    col = hist[column]
+    if isinstance(col, pd.DataFrame):
+        col = col.iloc[:, 0]
+    return pd.Series(col.to_numpy(dtype=float), index=_session_dates_index(hist)).dropna()
+
+def _scan_sources(ticker: str, on_date: date, window_days: int) -> pd.DataFrame:
+    dcs, _ = _yahoo_chart_series(ticker, on_date - timedelta(days=window_days), on_date)
+    chart = pd.Series(dict(dcs or []), dtype=float)
+    yfc = _close_series(yf_history(ticker, start=on_date - timedelta(days=window_days), end=on_date + timedelta(days=1)))
+    both = pd.concat({"chart": chart, "yf": yfc}, axis=1)
+    if both.empty:
+        return both
+    both = both[(both.index >= on_date - timedelta(days=window_days)) & (both.index <= on_date)]
+    both.index.name = "date"
+    return both.assign(ticker=ticker).reset_index()
+
+def scan_feed_discrepancies(tickers, on_date: date, window_days: int = 20) -> pd.DataFrame:
+    """
+    Fetch chart bars and yfinance bars for every ticker concurrently, align
+    on session date, and summarise per ticker: bars missing from either
+    source and the worst close disagreement (%).
+    """
+    tickers = list(dict.fromkeys(tickers))
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        frames = list(pool.map(lambda t: _scan_sources(t, on_date, window_days), tickers))
+    long = pd.concat([f for f in frames if not f.empty], ignore_index=True) if any(not f.empty for f in frames) else \
+        pd.DataFrame(columns=["ticker", "date", "chart", "yf"])
+
+    has_c, has_y = long["chart"].notna(), long["yf"].notna()
+    long["only_chart"] = has_c & ~has_y
+    long["only_yf"] = has_y & ~has_c
+    long["close_diff_pct"] = ((long["chart"] - long["yf"]).abs() / long["yf"] * 100.0).where(has_c & has_y)
+    long["close_mismatch"] = long["close_diff_pct"] > DISCREPANCY_CLOSE_TOL_PCT
+    long["odd_date"] = long["date"].where(long["only_chart"] | long["only_yf"] | long["close_mismatch"])
+
+    g = long.groupby("ticker")
+    report = pd.DataFrame({
+        "chart_bars": g["chart"].count(),
+        "yf_bars": g["yf"].count(),
+        "only_chart": g["only_chart"].sum(),
+        "only_yf": g["only_yf"].sum(),
+        "close_mismatches": g["close_mismatch"].sum(),
+        "max_close_diff_pct": g["close_diff_pct"].max(),
+        "last_chart_date": long[has_c].groupby("ticker")["date"].max(),
+        "last_yf_date": long[has_y].groupby("ticker")["date"].max(),
+        "mismatch_dates": g["odd_date"].agg(lambda s: ", ".join(d.isoformat() for d in s.dropna()[-5:])),
+    }).reindex(tickers)
+    report[["chart_bars", "yf_bars", "only_chart", "only_yf", "close_mismatches"]] = \
+        report[["chart_bars", "yf_bars", "only_chart", "only_yf", "close_mismatches"]].fillna(0).astype(int)
+    report["issues"] = report["only_chart"] + report["only_yf"] + report["close_mismatches"] + \
+        (report["chart_bars"] == 0) + (report["yf_bars"] == 0)
+    report.index.name = "ticker"
+    return report.reset_index().sort_values(["issues", "max_close_diff_pct"], ascending=False, na_position="last")
+
+# -----------------------------
+# Year-start baseline generation (batch job for reference_prices)
+# -----------------------------
+BASELINE_DIFF_TOLERANCE_PCT = 0.05
+
+def _chart_prev_year_last_bar(ticker: str, year: int):
+    """(date, close) of the last Yahoo chart bar before Jan 1 of year, or (None, None)."""
+    dcs, _ = _yahoo_chart_series(ticker, date(year - 1, 12, 15), date(year - 1, 12, 31))
+    prior = [(d, c) for d, c in (dcs or []) if d < date(year, 1, 1)]
+    return prior[-1] if prior else (None, None)
+
+def derive_year_baseline(ticker: str, year: int, use_price_return: bool = True) -> dict:
+    """
+    Baseline for one ticker: close on the venue's official last session of
+    year-1 from cached bars, else the last Yahoo chart bar before Jan 1.
+    """
+    series = "close" if use_price_return else "adjclose"
+    out = {"ticker": ticker, "price": None, "date": None, "series": series, "source": None}
+    window = [(date(year - 1, 12, 15), date(year - 1, 12, 31))]
+    session = official_prev_year_last_session(ticker, year)
+    if session is not None:
+        hist = fetch_bars(ticker, window)
+        px = baseline_from_hist_on_or_before(hist, session, use_price_return)
+        if px:
+            out.update(price=px, date=session.isoformat(), source=f"official {ticker_calendar_code(ticker)}")
+            return out
+    if use_price_return:  # chart closes are price-only
+        d, px = _chart_prev_year_last_bar(ticker, year)
+        if px:
+            out.update(price=px, date=d.isoformat(), source="yahoo chart")
+            return out
+    hist = fetch_bars(ticker, window)
+    px, pos = last_close_on_or_before_date(hist, date(year - 1, 12, 31), use_price_return)
+    if px:
+        out.update(price=px, date=_session_dates_index(hist)[pos].isoformat(), source="yfinance bars")
+    return out
+
+def generate_year_baselines(year: int, use_price_return: bool = True, tickers=None) -> pd.DataFrame:
+    """
+    Derive baselines for every ticker (default: the stocks table) concurrently
+    and compare with existing reference_prices rows for the year.
+    """
+    if tickers is None:
+        tickers = db_all_stocks()["ticker"].tolist()
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        derived = list(pool.map(lambda t: derive_year_baseline(t, year, use_price_return), tickers))
+    report = pd.DataFrame(derived, columns=["ticker", "price", "date", "series", "source"])
+    existing = db_all_references(year)[["ticker", "price", "date", "notes"]].rename(
+        columns={"price": "existing_price", "date": "existing_date", "notes": "existing_notes"})
+    report = report.merge(existing, on="ticker", how="left")
+    price = pd.to_numeric(report["price"], errors="coerce")
+    prev = pd.to_numeric(report["existing_price"], errors="coerce")
+    report["diff_pct"] = (price - prev) / prev * 100.0
+    report["status"] = np.select(
+        [price.isna(), prev.isna(), report["diff_pct"].abs() <= BASELINE_DIFF_TOLERANCE_PCT],
+        ["failed", "new", "matches"],
+        default="differs",
+    )
+    return report
+
+def write_year_baselines(report: pd.DataFrame, year: int, overwrite: bool = False) -> int:
+    """Bulk-upsert generated rows ('new', plus 'differs' when overwrite). Returns rows written."""
+    keep = report["status"].eq("new") | (overwrite & report["status"].eq("differs"))
+    todo = report[keep]
+    db_set_references_bulk(
+        (t, year, p, d, s, f"auto {date.today().isoformat()}: {src}")
+        for t, p, d, s, src in todo[["ticker", "price", "date", "series", "source"]].itertuples(index=False, name=None)
+    )
+    return len(todo)
+
+# -----------------------------
+# Background cache warmer (runs shortly after each venue closes)
+# -----------------------------
+WARMER_DELAY_AFTER_CLOSE = pd.Timedelta(minutes=20)  # let Yahoo settle the closing bar
+WARMER_MAX_SLEEP_S = 3600
+
+def warm_ticker(ticker: str) -> bool:
+    """Pre-fetch everything a Run for today needs: bars, the 5D and YTD chart windows and the last price."""
+    today = date.today()
+    hist = planned_history(ticker, today, n_back=10, need_ytd=True)
+    if hist is None or hist.empty:
+        return False
+    yahoo_pct_change_n_bars(ticker, today, 5, use_live_when_today=False)
+    yahoo_ytd_via_chart(ticker, today.year, today, use_live_when_today=False)
+    live_last_price(ticker)
+    return True
+
+def _warmer_universe() -> dict:
+    """calendar code -> tickers, from the stocks table plus the index list."""
+    by_cal = {}
+    symbols = db_all_stocks()["ticker"].tolist() + [i["ticker"] for i in INDEX_DEFS]
+    for t in symbols:
+        by_cal.setdefault(venue_calendar_code(t), []).append(t)
+    return by_cal
+
+def _cache_warmer_loop(state: dict):
+    while not state["stop"].is_set():
+        now = pd.Timestamp.now(tz="UTC").floor("min")
+        wake = now + pd.Timedelta(seconds=WARMER_MAX_SLEEP_S)
+        try:
+            universe = _warmer_universe()
+        except Exception:
+            universe = {}
+        for cal_code, tickers in universe.items():
+            try:
+                cal = xcals.get_calendar(cal_code)
+                last_close = cal.previous_close(now)
+                wake = min(wake, cal.next_close(now) + WARMER_DELAY_AFTER_CLOSE)
+            except Exception:
+                continue
+            if state["warmed"].get(cal_code) == last_close or now < last_close + WARMER_DELAY_AFTER_CLOSE:
+                continue
+            if cal.is_open_on_minute(now):
+                continue  # started mid-session: wait for this session's close
+            ok = sum(1 for t in tickers if not state["stop"].is_set() and warm_ticker(t))
+            state["warmed"][cal_code] = last_close
+            state["log"].append(f"{pd.Timestamp.now(tz='UTC'):%Y-%m-%d %H:%M}Z {cal_code}: warmed {ok}/{len(tickers)} after close {last_close:%Y-%m-%d %H:%M}Z")
+            del state["log"][:-50]
+        state["next_wake"] = wake
+        state["stop"].wait(max(30.0, (wake - pd.Timestamp.now(tz="UTC")).total_seconds()))
+
+@st.cache_resource
+def cache_warmer() -> Optional[dict]:
+    """Start the warmer thread once per process (needs exchange_calendars; CACHE_WARMER=false disables)."""
+    if not _HAS_XCALS or str(st.secrets.get("CACHE_WARMER", "true")).lower() in ("0", "false", "no"):
+        return None
+    state = {"stop": threading.Event(), "warmed": {}, "log": [], "next_wake": None}
+    threading.Thread(target=_cache_warmer_loop, args=(state,), name="cache-warmer", daemon=True).start()
+    return state
+
+# -----------------------------
+# FX normalization (optional base-currency view)
+# -----------------------------
+FX_BASE_CHOICES = ["Local", "EUR", "USD", "GBP"]
+FX_MINOR_UNITS = {"GBp": ("GBP", 0.01)}  # listing currency -> (ISO major, scale)
+
+def _fx_major(cur: str):
+    return FX_MINOR_UNITS.get(cur, (cur, 1.0))
+
+def fx_anchor_dates(on_date: date, cal_code: Optional[str]) -> dict:
+    """
+    The dates the equity legs are measured on, from the venue calendar: the
+    last session on/before on_date, the session five before it (the 5D base
+    bar) and the previous year's last session. Weekdays without a calendar.
+    """
+    start = date(on_date.year - 1, 12, 1)
+    sessions = None
+    if _HAS_XCALS and cal_code:
+        try:
+            cal = xcals.get_calendar(cal_code)
+            sessions = cal.sessions_in_range(pd.Timestamp(start), pd.Timestamp(on_date))
+            if len(sessions) and cal.session_open(sessions[-1]) > pd.Timestamp.now(tz="UTC"):
+                sessions = sessions[:-1]  # today's session has no bar yet
+        except Exception:
+            sessions = None
+    if sessions is None or len(sessions) == 0:
+        sessions = pd.bdate_range(start, on_date)
+    days = [d.date() for d in sessions]
+    prev_year = [d for d in days if d.year < on_date.year]
+    return {
+        "on": days[-1] if days else on_date,
+        "d5": days[-6] if len(days) >= 6 else on_date - timedelta(days=7),
+        "ytd": prev_year[-1] if prev_year else date(on_date.year - 1, 12, 31),
+    }
+
+def fx_listing_keys(df: pd.DataFrame) -> pd.MultiIndex:
+    """(currency, venue calendar) per row: FX anchors follow each listing's sessions."""
+    return pd.MultiIndex.from_arrays([df["Currency"].astype(str), df["Ticker"].map(venue_calendar_code)])
+
+def fx_rates_for_run(listings, base: str, on_date: date) -> pd.DataFrame:
+    """
+    One row per (listing currency, venue calendar) with the multiplier into
+    `base` on the dates the equity legs use (see fx_anchor_dates). Each FX pair
+    (e.g. GBPEUR=X) is fetched once through the provider chain; GBp and GBP
+    share the GBP pair with a x0.01 scale.
+    """
+    pair_hist = {}
+    rates = {}
+    for cur, cal_code in sorted(set(listings)):
+        anchors = fx_anchor_dates(on_date, cal_code)
+        major, scale = _fx_major(cur)
+        if major == base:
+            rates[(cur, cal_code)] = {k: scale for k in anchors}
+            continue
+        pair = f"{major}{base}=X"
+        if pair not in pair_hist:
+            h, _ = provider_call("bars", pair, [(date(on_date.year - 1, 12, 15), on_date)])
+            pair_hist[pair] = h if h is not None else pd.DataFrame()
+        h = pair_hist[pair]
+        vals = {}
+        for k, d in anchors.items():
+            v, _ = last_close_on_or_before_date(h, d, use_price_return=True) if not h.empty else (None, None)
+            vals[k] = v * scale if v else np.nan
+        rates[(cur, cal_code)] = vals
+    fx = pd.DataFrame.from_dict(rates, orient="index", columns=["on", "d5", "ytd"])
+    fx.index = pd.MultiIndex.from_tuples(fx.index, names=["Currency", "Calendar"]) if len(fx) else fx.index
+    return fx
+
+def apply_fx_view(df: pd.DataFrame, fx: pd.DataFrame, base: str) -> pd.DataFrame:
+    """Add base-currency Price / 5D / YTD columns in one vectorized pass (no per-row lookups)."""
+    r = fx.reindex(fx_listing_keys(df))
+    on, d5, ytd = (r[c].to_numpy(dtype=float) for c in ("on", "d5", "ytd"))
+    price = pd.to_numeric(df["Price"], errors="coerce").to_numpy(dtype=float)
+    c5 = pd.to_numeric(df["5D % Change"], errors="coerce").to_numpy(dtype=float)
+    cy = pd.to_numeric(df["YTD % Change"], errors="coerce").to_numpy(dtype=float)
+    out = df.copy()
+    out[f"Price ({base})"] = price * on
+    out[f"5D % ({base})"] = ((1.0 + c5 / 100.0) * (on / d5) - 1.0) * 100.0
+    out[f"YTD % ({base})"] = ((1.0 + cy / 100.0) * (on / ytd) - 1.0) * 100.0
+    return out
+
+# -----------------------------
+# Export stage (CSV / XLSX / JSON built together, cached per table)
+# -----------------------------
+REGION_ORDER = ["Ireland", "UK", "Europe", "US"]
+REGION_LABELS = {
+    "Ireland": f"Ireland ({currency_symbol('EUR')})",
+    "UK":      f"UK (GBX)",
+    "Europe":  f"Europe ({currency_symbol('EUR')})",
+    "US":      f"US ({currency_symbol('USD')})",
+}
+EXPORT_VALUE_COLS = ["Price", "5D % Change", "YTD % Change"]
+
+def _num_or_none(v):
+    return None if v is None or pd.isna(v) else float(v)
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def build_exports(df: pd.DataFrame, idx_df: pd.DataFrame, dp: int, as_of: str, extra_cols: tuple = ()) -> dict:
+    """
+    Walk the computed table once and emit all download formats:
+      csv  - the region-blocked CSV (UTF-8 BOM, company commas stripped)
+      xlsx - write-only workbook, one sheet per region plus "Indices"
+      json - {"as_of", "decimals", "regions": {region: [...]}, "indices": [...]}
+    Cached on the table contents, so reruns and repeat downloads reuse the bytes.
+    """
+    from openpyxl import Workbook
+
+    fmt = f"{{:.{dp}f}}"
+    value_cols = EXPORT_VALUE_COLS + list(extra_cols)
+
+    csv_out = io.StringIO()
+    writer = csv.writer(csv_out, quoting=csv.QUOTE_MINIMAL)
+    wb = Workbook(write_only=True)
+    payload = {"as_of": as_of, "decimals": dp, "regions": {}, "indices": []}
+
+    for region in REGION_ORDER:
+        g = df[df["Region"] == region]
+        if g.empty:
+            continue
+        writer.writerow([REGION_LABELS[region], "Last price", "5D % change", "YTD % change"] + list(extra_cols))
+        ws = wb.create_sheet(title=region)
+        ws.append(["Company", "Currency"] + value_cols)
+        records = []
+        for company, currency, *vals in g[["Company", "Currency"] + value_cols].itertuples(index=False, name=None):
+            vals = [_num_or_none(v) for v in vals]
+            writer.writerow([(company or "").replace(",", "")] + ["" if v is None else fmt.format(v) for v in vals])
+            ws.append([company, currency] + [None if v is None else round(v, dp) for v in vals])
+            records.append({"company": company, "currency": currency, **dict(zip(value_cols, vals))})
+        payload["regions"][region] = records
+
+    if idx_df is not None and not idx_df.empty:
+        ws = wb.create_sheet(title="Indices")
+        cols = list(idx_df.columns)
+        ws.append(cols)
+        for rec in idx_df.itertuples(index=False, name=None):
+            ws.append([v if isinstance(v, str) else _num_or_none(v) for v in rec])
+            payload["indices"].append({c: (v if isinstance(v, str) else _num_or_none(v)) for c, v in zip(cols, rec)})
+
+    xlsx_out = io.BytesIO()
+    wb.save(xlsx_out)
+    return {
+        "csv": ("\ufeff" + csv_out.getvalue()).encode("utf-8"),
+        "xlsx": xlsx_out.getvalue(),
+        "json": json.dumps(payload, ensure_ascii=False, indent=1).encode("utf-8"),
+    }
+
+# -----------------------------
+# Run result cache (keyed by run parameters, stored at full precision)
+# -----------------------------
+RESULT_TTL_TODAY_S = 60          # today's numbers move; reuse only briefly
+RESULT_TTL_HISTORICAL_S = 3600
+SESSION_RESULTS_MAX = 8
+
+def run_params_key(target_date: date, tickers, **toggles) -> tuple:
+    """Everything that changes computed numbers. Display-only controls (DP, FX view, charts) stay out."""
+    return (target_date.isoformat(), tuple(sorted(tickers))) + tuple(sorted(toggles.items()))
+
+@st.cache_resource
+def _run_result_cache() -> dict:
+    return {"lock": threading.Lock(), "entries": {}}
+
+def run_result_store(key: tuple, result: dict):
+    cache = _run_result_cache()
+    with cache["lock"]:
+        entries = cache["entries"]
+        if len(entries) >= SESSION_RESULTS_MAX * 4:
+            entries.pop(next(iter(entries)))
+        entries[key] = (time.time(), result)
+
+def run_result_lookup(key: tuple) -> Optional[dict]:
+    """A result computed by any session for the same parameters, if still fresh."""
+    cache = _run_result_cache()
+    with cache["lock"]:
+        hit = cache["entries"].get(key)
+    if hit is None:
+        return None
+    computed_at, result = hit
+    ttl = RESULT_TTL_TODAY_S if result["target_date"] >= date.today() else RESULT_TTL_HISTORICAL_S
+    return result if time.time() - computed_at <= ttl else None
+
+def remember_session_result(key: tuple, result: dict):
+    results = st.session_state.setdefault("run_results", {})
+    results.pop(key, None)
+    results[key] = result
+    while len(results) > SESSION_RESULTS_MAX:
+        results.pop(next(iter(results)))
+
+# -----------------------------
+# Result history (final stock rows, one gzipped CSV per month in the repo)
+# -----------------------------
+# Rows are keyed by Date + Params (the toggles that change numbers) + Ticker, so a
+# fresh container can show a past Run from the repo instead of refetching. Only
+# passive reruns read it: an explicit Run always recomputes (baselines may have
+# been edited since the rows were stored) and its rows replace the stored ones.
+GH_HISTORY_DIR = "data/history"
+HISTORY_BATCH_ROWS = 500          # commit once this many rows are pending...
+HISTORY_BATCH_AGE_S = 6 * 3600    # ...or the oldest pending row is this old
+HISTORY_KEY_COLS = ["Date", "Params", "Ticker"]
+HISTORY_MONTH_TTL_S = 15 * 60     # re-read a month file other containers may have extended
+HISTORY_PUT_ATTEMPTS = 4          # read-merge-write tries per month when the sha goes stale
+HISTORY_FLUSH_POLL_S = 60         # background flush check (runs on the retry-queue thread)
+
+def history_path(month: str) -> str:
+    return f"{GH_HISTORY_DIR}/{month}.csv.gz"
+
+def history_params(run_key: tuple) -> str:
+    """run_key's toggles that change stock rows, as a stable string."""
+    return ";".join(f"{k}={v}" for k, v in run_key[2:] if k != "show_indices")
+
+def history_enabled() -> bool:
+    return bool(_gh_repo()[0] and _gh_headers()) and not cassette_active()
+
+@st.cache_resource
+def _history() -> dict:
+    # months: "YYYY-MM" -> (read_at, rows as last read/committed); pending: frames awaiting a commit
+    return {"lock": threading.Lock(), "months": {}, "pending": [], "pending_since": None}
+
+def _history_read_month(month: str) -> pd.DataFrame:
+    chunks = list(gh_csv_chunks(history_path(month), compression="gzip", encoding="utf-8",
+                                dtype={"Date": str, "Params": str, "Ticker": str}, keep_default_na=True))
+    if not chunks:
+        return pd.DataFrame(columns=HISTORY_KEY_COLS)
+    df = pd.concat(chunks, ignore_index=True)
+    if "Manual" in df.columns:
+        df["Manual"] = df["Manual"].fillna("")
+    return df
+
+def _history_read_snapshot(month: str):
+    """
+    A month's rows and the sha they belong to, read right before a write. The
+    sha is read first: if the body read after it is newer, the PUT still
+    carries the older sha and GitHub rejects it, so nothing is overwritten.
+    """
+    meta = gh_get_file(history_path(month))
+    if not meta:
+        return pd.DataFrame(columns=HISTORY_KEY_COLS), None
+    if meta.get("encoding") == "base64" and meta.get("content"):  # small files: body and sha in one read
+        raw = gzip.decompress(base64.b64decode(meta["content"]))
+        df = pd.read_csv(io.BytesIO(raw), dtype={"Date": str, "Params": str, "Ticker": str}, keep_default_na=True)
+        if "Manual" in df.columns:
+            df["Manual"] = df["Manual"].fillna("")
+        return df, meta.get("sha")
+    return _history_read_month(month), meta.get("sha")
+
+def history_lookup(run_key: tuple, tickers) -> pd.DataFrame:
+    """Stored final rows for this Run's date and toggles (any subset of tickers)."""
+    month = run_key[0][:7]
+    h = _history()
+    with h["lock"]:
+        read_at, stored = h["months"].get(month, (0.0, None))
+    if stored is None or time.time() - read_at > HISTORY_MONTH_TTL_S:
+        try:
+            stored = _history_read_month(month)
+        except Exception:
+            stored = stored if stored is not None else pd.DataFrame(columns=HISTORY_KEY_COLS)
+        with h["lock"]:
+            h["months"][month] = (time.time(), stored)
+    with h["lock"]:
+        frames = [stored] + [p for p in h["pending"] if (p["Date"].str[:7] == month).any()]
+    df = pd.concat(frames, ignore_index=True)
+    df = df[(df["Date"] == run_key[0]) & (df["Params"] == history_params(run_key)) & df["Ticker"].isin(list(tickers))]
+    return df.drop_duplicates("Ticker", keep="last").drop(columns=["Date", "Params"]).reset_index(drop=True)
+
+def history_result(run_key: tuple, tickers, target_date: date) -> Optional[dict]:
+    """A Run-shaped result from stored rows if every ticker is stored (indices are not kept)."""
+    rows = history_lookup(run_key, tickers)
+    if rows.empty or set(tickers) - set(rows["Ticker"]):
+        return None
+    return {"target_date": target_date, "rows": rows.assign(Status=""), "idx": pd.DataFrame(),
+            "idx_series": {}, "skipped": [], "budget_s": None, "from_history": True}
+
+def history_append(run_key: tuple, rows: pd.DataFrame) -> int:
+    """Queue a Run's settled rows whose target session is final at their venue."""
+    if rows.empty:
+        return 0
+    day = date.fromisoformat(run_key[0])
+    settled = rows["Status"].fillna("").isin(["", STATUS_RETRIED]) if "Status" in rows.columns else True
+    final = rows["Ticker"].map(lambda t: day <= final_through(t))
+    snap = rows[settled & final].drop(columns=["Status"], errors="ignore")
+    if snap.empty:
+        return 0
+    snap.insert(0, "Params", history_params(run_key))
+    snap.insert(0, "Date", run_key[0])
+    h = _history()
+    with h["lock"]:
+        h["pending"].append(snap)
+        h["pending_since"] = h["pending_since"] or time.time()
+    return len(snap)
+
+def history_pending() -> int:
+    h = _history()
+    with h["lock"]:
+        return sum(len(p) for p in h["pending"])
+
+def history_flush(force: bool = False):
+    """
+    Commit pending rows once a batch is due (or when forced): per month, re-read
+    the repo's file and sha, merge (latest row wins per key) and write it back
+    gzipped, re-reading and retrying if another writer got there first. Rows of
+    months that fail to commit go back in the queue. Returns (ok, msg).
+    """
+    h = _history()
+    with h["lock"]:
+        n = sum(len(p) for p in h["pending"])
+        if not n:
+            return True, "No result history pending"
+        if not (force or n >= HISTORY_BATCH_ROWS or time.time() - h["pending_since"] >= HISTORY_BATCH_AGE_S):
+            return True, f"{n} history row(s) pending"
+        batch = pd.concat(h["pending"], ignore_index=True)
+        h["pending"], h["pending_since"] = [], None
+    msgs, failed = [], []
+    for month, new in batch.groupby(batch["Date"].str[:7]):
+        for attempt in range(HISTORY_PUT_ATTEMPTS):
+            try:
+                old, sha = _history_read_snapshot(month)
+                merged = (pd.concat([old, new], ignore_index=True)
+                            .drop_duplicates(HISTORY_KEY_COLS, keep="last")
+                            .sort_values(HISTORY_KEY_COLS)
+                            .reset_index(drop=True))
+                buf = io.BytesIO()
+                with gzip.GzipFile(fileobj=buf, mode="wb", mtime=0) as gz:
+                    gz.write(merged.to_csv(index=False).encode("utf-8"))
+                ok, msg = gh_put_file(history_path(month), buf.getvalue(), f"history: {month} (+{len(new)} rows)", sha)
+            except Exception as e:
+                ok, msg = False, f"{type(e).__name__}: {e}"
+            if ok or not gh_put_conflict(msg):
+                break
+            time.sleep(0.5 * (attempt + 1))  # another writer committed: re-read and merge again
+        if ok:
+            with h["lock"]:
+                h["months"][month] = (time.time(), merged)
+        else:
+            failed.append(new)
+        msgs.append(f"{month}: {msg}")
+    if failed:
+        with h["lock"]:
+            h["pending"] = failed + h["pending"]
+            h["pending_since"] = h["pending_since"] or time.time()
+    return not failed, "; ".join(msgs)
+
+# -----------------------------
+# Per-ticker compute (bar bases as arrays)
+# -----------------------------
+# The per-ticker base maths lives in compute_pool so pool workers can import it.
+FLAVOURS, BASE_FIELDS = compute_pool.FLAVOURS, compute_pool.BASE_FIELDS
+day_number, ticker_bases = compute_pool.day_number, compute_pool.ticker_bases
+
+def bars_arrays(hist: pd.DataFrame):
+    """Bars as compact arrays: (day numbers, closes[:, Close/Adj Close])."""
+    idx = pd.to_datetime(hist.index)
+    if idx.tz is not None:
+        idx = idx.tz_localize(None)
+    days = idx.normalize().to_numpy().astype("datetime64[D]").astype(np.int64)
+    cols = []
+    for name in FLAVOURS:
+        col = hist[name] if name in hist.columns else hist["Close"]
+        if isinstance(col, pd.DataFrame):
+            col = col.iloc[:, 0]
+        cols.append(pd.to_numeric(col, errors="coerce").to_numpy(dtype=float))
+    return days, np.column_stack(cols)
+
+def stock_row(s: dict, bases: np.ndarray, manual_ref, target_date: date, year: int, exact_yahoo_mode: bool) -> Optional[dict]:
+    """
+    Finish one stock's row from its bar bases (ticker_bases) for
+    both flavours: price return (Close, live price if today, chart-exact when
+    enabled) and total return (Adj Close). None when neither has a close.
+    """
+    tkr = s["ticker"]
+    row = {
+        "Ticker": tkr,
+        "Company": s["name"],
+        "Manual": "🧭" if manual_ref is not None else "",
+        "Region": s["region"],
+        "Currency": s["currency"],
+    }
+    for flavour, use_pr in ((0, True), (1, False)):
+        sfx = "" if use_pr else TR_SUFFIX
+        price_eod, c_5ago, base_official, base_prev_year = (None if np.isnan(v) else float(v) for v in bases[flavour])
+        if price_eod is None:
+            row.update({f"Price{sfx}": None, f"5D % Change{sfx}": None, f"YTD % Change{sfx}": None, f"YTD Base{sfx}": None})
+            continue
+
+        live_price = None
+        if use_pr and target_date == date.today():
+            live_price, _ = provider_call("live", tkr)
+
+        price_num = float(live_price) if (live_price is not None) else price_eod
+
+        chg_5d = None
+        if exact_yahoo_mode and use_pr:
+            chg_5d, _ = provider_call("pct_5d", tkr, target_date, True)
+        if chg_5d is None and c_5ago:
+            chg_5d = (price_num - c_5ago) / c_5ago * 100.0
+
+        chg_ytd, ytd_base = None, None
+        if manual_ref is not None:
+            base = float(manual_ref["price"])
+            chg_ytd, ytd_base = (price_num - base) / base * 100.0, "manual"
+        elif base_official:
+            chg_ytd, ytd_base = (price_num - base_official) / base_official * 100.0, "calendar"
+        else:
+            if exact_yahoo_mode and use_pr:
+                chg_ytd, _ = provider_call("ytd", tkr, year, target_date, True)
+                ytd_base = "chart" if chg_ytd is not None else None
+            if chg_ytd is None and base_prev_year:
+                chg_ytd, ytd_base = (price_num - base_prev_year) / base_prev_year * 100.0, "prev-year"
+
+        row.update({f"Price{sfx}": price_num, f"5D % Change{sfx}": chg_5d, f"YTD % Change{sfx}": chg_ytd,
+                    f"YTD Base{sfx}": ytd_base})
+
+    if row["Price"] is None and row[f"Price{TR_SUFFIX}"] is None:
+        return None
+    return row
+
+def fetch_stock_inputs(s: dict, ctx: dict) -> Optional[dict]:
+    """
+    Bars and baselines one stock's row needs (ctx: target_date, year, span_from
+    and the baseline toggles). None when no provider returned bars.
+    """
+    tkr = s["ticker"]
+    manual_ref = db_get_reference(tkr, ctx["year"]) if ctx["use_manual_baselines"] else None
+    windows = plan_fetch_windows(tkr, ctx["target_date"], n_back=5, need_ytd=manual_ref is None, span_from=ctx["span_from"])
+    hist, src = provider_call("bars", tkr, windows)
+    if hist is None or hist.empty:
+        return None
+    baseline_session = None
+    if manual_ref is None and ctx["use_official_calendars"] and _HAS_XCALS:
+        baseline_session = official_prev_year_last_session(tkr, ctx["year"])
+    days, closes = bars_arrays(hist)
+    return {
+        "manual_ref": manual_ref, "windows": windows, "hist": hist, "src": src,
+        "days": days, "closes": closes,
+        "baseline_day": day_number(baseline_session) if baseline_session else -1,
+        "window_day": day_number(windows[-1][0]),  # start of the window holding the target bar
+    }
+
+def compute_stock_row(s: dict, ctx: dict) -> Optional[dict]:
+    """One stock's complete row (extra horizons included) outside the Run loop."""
+    inputs = fetch_stock_inputs(s, ctx)
+    if inputs is None:
+        return None
+    bases = ticker_bases(
+        inputs["days"], inputs["closes"], day_number(ctx["target_date"]), 5,
+        inputs["baseline_day"], day_number(date(ctx["year"] - 1, 12, 31)), inputs["window_day"],
+    )
+    row = stock_row(s, bases, inputs["manual_ref"], ctx["target_date"], ctx["year"], ctx["exact_yahoo_mode"])
+    if row is not None and ctx["span_from"] is not None:
+        tkr = s["ticker"]
+        for sfx, col in (("", "Close"), (TR_SUFFIX, "Adj Close")):
+            hz = horizon_returns(
+                pd.DataFrame({tkr: _close_series(inputs["hist"], col)}), pd.Series({tkr: row[f"Price{sfx}"]}),
+                ctx["target_date"], {tkr: venue_calendar_code(tkr)},
+            )
+            row.update(hz.add_suffix(sfx).iloc[0].to_dict())
+    return row
+
+# --- Process-pool stage: big Runs fetch raw chart payloads in-process and shard
+# the decoding and per-ticker bases across worker processes (compute_pool) ---
+@st.cache_resource
+def compute_executor(processes: int):
+    return compute_pool.new_executor(processes)
+
+def pool_stock_inputs(stocks, ctx: dict, processes: int) -> dict:
+    """
+    fetch_stock_inputs for many stocks at once, bases included ("bases"): raw
+    Yahoo chart payloads are fetched here, then decoded and reduced in worker
+    processes. Stocks without a usable payload are left out; the caller
+    takes them through the provider chain as usual.
+    """
+    target_day = day_number(ctx["target_date"])
+    prev_year_end_day = day_number(date(ctx["year"] - 1, 12, 31))
+    metas, jobs = [], []
+    for s in stocks:
+        if fetch_deadline_passed():
+            break
+        tkr = s["ticker"]
+        manual_ref = db_get_reference(tkr, ctx["year"]) if ctx["use_manual_baselines"] else None
+        windows = plan_fetch_windows(tkr, ctx["target_date"], n_back=5, need_ytd=manual_ref is None, span_from=ctx["span_from"])
+        t0 = time.perf_counter()
+        payloads = tuple(_yahoo_chart_get_raw(tkr, _chart_params(a, b), window_end=b) for a, b in windows)
+        ok = all(p is not None for p in payloads)
+        _provider_record("yahoo_chart", "bars", ok, time.perf_counter() - t0)
+        if not ok:
+            continue
+        baseline_session = None
+        if manual_ref is None and ctx["use_official_calendars"] and _HAS_XCALS:
+            baseline_session = official_prev_year_last_session(tkr, ctx["year"])
+        baseline_day = day_number(baseline_session) if baseline_session else -1
+        window_day = day_number(windows[-1][0])
+        metas.append((tkr, manual_ref, windows, baseline_day, window_day))
+        jobs.append((payloads, baseline_day, window_day))
+    if not jobs:
+        return {}
+    try:
+        bases, lengths, days, closes = compute_pool.decode_bases(
+            jobs, target_day, 5, prev_year_end_day, compute_executor(processes), processes)
+    except Exception:  # a broken pool: start a fresh one next Run, decode here this time
+        compute_executor.clear()
+        bases, lengths, days, closes = compute_pool.decode_bases(jobs, target_day, 5, prev_year_end_day)
+    out = {}
+    for (tkr, manual_ref, windows, baseline_day, window_day), b, n, end in zip(metas, bases, lengths, np.cumsum(lengths)):
+        if not n:
+            continue
+        d, c = days[end - n:end], closes[end - n:end]
+        out[tkr] = {
+            "manual_ref": manual_ref, "windows": windows, "src": "yahoo_chart (pool)",
+            "hist": pd.DataFrame(c, index=pd.to_datetime(d, unit="D"), columns=FLAVOURS),
+            "days": d, "closes": c, "baseline_day": baseline_day, "window_day": window_day, "bases": b,
+        }
+    return out
+
+# -----------------------------
+# Retry queue (failed tickers re-attempted in the background with backoff)
+# -----------------------------
+# A Run keeps a placeholder row for each failed ticker; a process-wide worker
+# retries them and the results panel merges outcomes in as they arrive. The same
+# worker commits due result-history batches, so a Run never waits on GitHub.
+RETRY_BACKOFF_S = (5, 20, 60)   # wait before each attempt; attempts = len()
+RETRY_JOB_TTL_S = 3600          # forget a Run's retries after this
+RETRY_POLL_S = 3                # results panel refresh while retries are pending
+STATUS_PENDING, STATUS_RETRIED, STATUS_FAILED = "⏳ pending", "↻ retried", "✗ failed"
+
+@st.cache_resource
+def _retry_queue():
+    state = {"lock": threading.Lock(), "wake": threading.Event(), "jobs": {}, "flush_at": 0.0}
+    threading.Thread(target=_retry_loop, args=(state,), name="retry-queue", daemon=True).start()
+    return state
+
+def _retry_loop(state: dict):
+    while True:
+        now = time.monotonic()
+        due, next_at = [], None
+        with state["lock"]:
+            for key, job in list(state["jobs"].items()):
+                if now - job["created"] > RETRY_JOB_TTL_S:
+                    del state["jobs"][key]
+                    continue
+                for item in job["items"].values():
+                    if item["status"] != STATUS_PENDING:
+                        continue
+                    if item["next_at"] <= now:
+                        due.append((job, item))
+                    else:
+                        next_at = item["next_at"] if next_at is None else min(next_at, item["next_at"])
+        for job, item in due:
+            try:
+                row = compute_stock_row(item["stock"], job["ctx"])
+            except Exception:
+                row = None
+            if row is not None and history_enabled():
+                history_append(job["key"], pd.DataFrame([row]))
+            with state["lock"]:
+                item["attempts"] += 1
+                if row is not None:
+                    item.update(row={**row, "Status": STATUS_RETRIED}, status=STATUS_RETRIED)
+                elif item["attempts"] >= len(RETRY_BACKOFF_S):
+                    item["status"] = STATUS_FAILED
+                else:
+                    item["next_at"] = time.monotonic() + RETRY_BACKOFF_S[item["attempts"]]
+                    continue
+                job["version"] += 1
+        if due:
+            continue
+        if time.monotonic() >= state["flush_at"]:
+            state["flush_at"] = time.monotonic() + HISTORY_FLUSH_POLL_S
+            try:
+                if history_enabled():
+                    history_flush()
+            except Exception:
+                pass  # rows stay pending; next poll retries
+        wait_s = state["flush_at"] - time.monotonic()
+        if next_at is not None:
+            wait_s = min(wait_s, next_at - time.monotonic())
+        state["wake"].wait(max(0.5, wait_s))
+        state["wake"].clear()
+
+def retry_enqueue(run_key: tuple, stocks, ctx: dict):
+    """Replace run_key's retry job with this Run's failures (none drops the old job)."""
+    q = _retry_queue()
+    now = time.monotonic()
+    with q["lock"]:
+        if not stocks:
+            q["jobs"].pop(run_key, None)
+            return
+        job = {"key": run_key, "ctx": ctx, "items": {}, "version": 0, "created": now}
+        for s in stocks:
+            job["items"][s["ticker"]] = {"stock": s, "attempts": 0, "next_at": now + RETRY_BACKOFF_S[0],
+                                         "status": STATUS_PENDING, "row": None}
+        q["jobs"][run_key] = job
+    q["wake"].set()
+
+def retry_merge(run_key: tuple, rows: pd.DataFrame):
+    """
+    Apply retry outcomes to a Run's rows: retried rows replace their
+    placeholders, others show their status; a placeholder whose job was
+    replaced or expired is failed. Returns (rows, pending in rows, version).
+    """
+    q = _retry_queue()
+    with q["lock"]:
+        job = q["jobs"].get(run_key)
+        outcomes = {t: (i["status"], i["row"]) for t, i in job["items"].items()} if job else {}
+        version = job["version"] if job else 0
+    if "Status" not in rows.columns or not (rows["Status"] == STATUS_PENDING).any():
+        return rows, 0, version
+    rows = rows.copy()
+    orphaned = (rows["Status"] == STATUS_PENDING) & ~rows["Ticker"].isin(list(outcomes))
+    rows.loc[orphaned, "Status"] = STATUS_FAILED
+    retried = []
+    for tkr, (status, row) in outcomes.items():
+        if not (rows["Ticker"] == tkr).any():
+            continue
+        if row is not None:
+            retried.append(row)
+        else:
+            rows.loc[rows["Ticker"] == tkr, "Status"] = status
+    if retried:
+        rows = pd.concat([rows[~rows["Ticker"].isin([r["Ticker"] for r in retried])], pd.DataFrame(retried)], ignore_index=True)
+    pending = int((rows["Status"] == STATUS_PENDING).sum())
+    return rows, pending, version
+
+# -----------------------------
+# Progressive rendering while a Run is in flight
+# -----------------------------
+PROGRESS_REDRAW_S = 0.5  # redraw the in-progress tables at most this often
+
+def progress_render(box, rows: list, done: int, total: int, started: float, use_price_return: bool, dp: int):
+    """Redraw the in-progress view: done/total with ETA, then completed rows by region."""
+    elapsed = time.perf_counter() - started
+    eta = f"ETA {elapsed / done * (total - done):.0f}s" if done else "estimating…"
+    sfx = "" if use_price_return else TR_SUFFIX
+    value_cols = ["Price", "5D % Change", "YTD % Change"]
+    with box.container():
+        st.progress(done / total if total else 1.0, text=f"{done}/{total} tickers · {elapsed:.0f}s elapsed · {eta}")
+        if not rows:
+            return
+        df = pd.DataFrame(rows)
+        for region in REGION_ORDER:
+            g = df[df["Region"] == region].sort_values("Company")
+            if g.empty:
+                continue
+            view = g[["Company"] + [c + sfx for c in value_cols]].set_axis(["Company"] + value_cols, axis=1)
+            st.subheader(region)
+            st.dataframe(view.round(dp), use_container_width=True, hide_index=True)
+
+# -----------------------------
+# Streamlit UI
+# -----------------------------
+st.set_page_config(page_title="Stock Dashboard", layout="wide")
+st.title("📊 Stock Dashboard")
+st.caption("YTD can use official exchange calendars (Europe) or Yahoo’s chart feed. Manual baselines override when provided. Data persisted to your GitHub repo.")
+
+# Panels are fragments: a widget inside one reruns only that panel.
+# st.fragment is 1.37+; 1.33-1.36 ship it as st.experimental_fragment.
+_fragment = getattr(st, "fragment", None) or st.experimental_fragment
+
+def _rerun_panel():
+    try:
+        st.rerun(scope="fragment")
+    except Exception:
+        st.rerun()
+
+# Debug toggle + helper
+DEBUG_MODE = st.sidebar.toggle("Show debug info", value=False)
 
 _debug_box = None
 if DEBUG_MODE:
     _debug_box = st.sidebar.expander("Debug output", expanded=True)
+    _rate = rate_limiter_status()
+    if not _rate.empty:
+        _debug_box.caption("Outbound rate budget (before this run)")
+        _debug_box.dataframe(_rate, hide_index=True)
 
 def debug(msg):
     if DEBUG_MODE:
@@ -652,16 +2933,21 @@ def _gh_config_ok():
     repo, branch = _gh_repo()
     return bool(hdr and repo), (repo or "not set"), (branch or "main")
 
-ok_cfg, repo_name, branch_name = _gh_config_ok()
-with st.sidebar:
+@_fragment
+def github_sync_panel():
+    ok_cfg, repo_name, branch_name = _gh_config_ok()
     st.subheader("🔗 GitHub Sync")
     st.caption(f"Repo: {repo_name}\nBranch: {branch_name}")
     if ok_cfg:
         if st.button("↗️ Push data to GitHub now", key="push_sidebar"):
             ok,msg = sync_db_to_github("manual push")
             st.success(msg) if ok else st.warning(msg)
+        if st.button(f"🗂️ Commit result history now ({history_pending()} pending)", key="history_flush"):
+            ok, msg = history_flush(force=True)
+            st.success(msg) if ok else st.warning(msg)
         if st.button("⬇️ Pull latest from GitHub", key="pull_sidebar"):
             seed_db_from_github()
+            st.session_state["gh_seeded"] = True
             st.success("Pulled latest from repo.")
             st.rerun()
         if st.button("🔎 Test GitHub token", key="test_token"):
@@ -693,11 +2979,26 @@ with st.sidebar:
     else:
         st.warning("Set GITHUB_TOKEN, GITHUB_REPO, GITHUB_BRANCH in st.secrets.")
 
+with st.sidebar:
+    github_sync_panel()
+
 # Toggles
 use_price_return = st.toggle(
     "Match Yahoo style for returns (use Close; live price if today)",
     value=True,
-    help="ON = price return (Close). OFF = total return (Adj Close). Live price used for today's numerator."
+    help="ON = price return (Close). OFF = total return (Adj Close). Live price used for today's numerator. "
+         "Both are computed on every Run, so switching needs no refetch."
+)
+show_both_returns = st.toggle(
+    "Show the other return flavour too",
+    value=False,
+    help="Adds 5D/YTD columns for total return (or price return when the toggle above is off)."
+)
+extra_horizons = st.multiselect(
+    "Extra horizons",
+    EXTRA_HORIZONS,
+    default=[],
+    help="Computed together from one year of bars per ticker; changing the selection needs no refetch."
 )
 exact_yahoo_mode = st.toggle(
     "Exact Yahoo YTD (chart feed)",
@@ -720,9 +3021,12 @@ round_two_dp = st.toggle(
     help="Switch between rounding numbers to 1 or 2 decimal places across Price and % columns."
 )
 DP = 2 if round_two_dp else 1
-price_fmt = f"{{:.{DP}f}}"
-pct_fmt   = f"{{:.{DP}f}}"
-
+fx_base = st.selectbox(
+    "Base-currency view",
+    FX_BASE_CHOICES,
+    index=0,
+    help="Local = prices/returns in each listing currency. Otherwise adds converted Price, 5D and YTD columns."
+)
 show_indices = st.toggle(
     "Show index 5-day trends (ISEQ, FTSE 100, S&P 500, DAX)",
     value=True
@@ -731,16 +3035,42 @@ show_index_charts = st.checkbox(
     "Mini charts for indices (last ~10 sessions)",
     value=False
 )
+live_mode = st.toggle(
+    "Live mode (today only: auto-refresh last prices)",
+    value=False,
+    help="Keeps closes and 5D/YTD baselines from the last Run and re-fetches only batched last prices."
+)
+live_interval_s = st.select_slider("Live refresh interval (s)", LIVE_INTERVAL_CHOICES, value=15) if live_mode else None
+fetch_budget_s = st.sidebar.number_input(
+    "Fetch time budget per Run (seconds)",
+    min_value=10, max_value=1800, value=FETCH_DEADLINE_DEFAULT_S, step=10,
+    help="After this, remaining tickers are skipped and partial results are shown."
+)
+_cpus = max(1, os.cpu_count() or 1)
+compute_processes = st.sidebar.number_input(
+    "Compute processes (1 = in-process)",
+    min_value=1, max_value=_cpus, value=min(int(st.secrets.get("COMPUTE_PROCESSES", 1)), _cpus),
+    help=f"Above 1, Runs of {compute_pool.POOL_MIN_TICKERS}+ stocks fetch raw Yahoo chart payloads first, "
+         "then decode them and compute per-ticker bases across processes."
+)
+if cassette_active():
+    cs = cassette_status()
+    st.sidebar.caption(
+        f"HTTP cassette {cs['mode']} ({os.path.basename(cs['path'])}): {cs['entries']} entries · "
+        f"recorded {cs['recorded']} · replayed {cs['replayed']} · missing {cs['missing']}"
+    )
 
-init_db_with_defaults()
+_db_schema = init_db()
+debug(f"DB schema v{_db_schema['version']} (applied this process: {_db_schema['applied'] or 'none'}; seeded defaults: {_db_schema['seeded']})")
+_warmer = cache_warmer()
 if _gh_headers() and _gh_repo()[0]:
-    seed_db_from_github()
+    if not st.session_state.get("gh_seeded"):
+        seed_db_from_github()
+        st.session_state["gh_seeded"] = True
     st.info("🔗 Seeded data from GitHub (if files present).")
 else:
     st.warning("GitHub sync not configured (set GITHUB_* secrets) — using local ephemeral DB.")
 
-stocks_df = db_all_stocks()
-
 colA, colB = st.columns([1,1])
 with colA:
     selected_date = st.date_input("Select date", value=date.today())
@@ -749,203 +3079,278 @@ with colB:
     run = st.button("Run")
 
 # ---------- Diagnostics: Yahoo vs yfinance (optional helper) ----------
-with st.expander("🧪 Data diagnostics (Yahoo bars vs yfinance)"):
-    tkr_test = st.text_input("Ticker to inspect", value="A5G.IR")
-    dt_test = st.date_input("Date (on/before)", value=date.today(), key="diag_date")
-    if st.button("Inspect feed"):
-        dcs, meta = _yahoo_chart_series(tkr_test, max_range="3mo", interval="1d")
-        if dcs:
-            last12 = dcs[-12:]
-            st.write("Yahoo chart last 12 bar dates:", [d.isoformat() for d, _ in last12])
-            upto = [c for (d, c) in dcs if d <= dt_test]
-            st.write(f"Bars up to {dt_test.isoformat()}: {len(upto)}")
-            st.write("Yahoo 5D % (if available):", yahoo_pct_change_n_bars(tkr_test, dt_test, 5, use_live_when_today=True))
-        else:
-            st.warning("No chart bars returned from Yahoo (after retries).")
-
-        h_diag = yf.download(tkr_test, start=dt_test - timedelta(days=20), end=dt_test + timedelta(days=2), progress=False, auto_adjust=False)
-        if not h_diag.empty:
-            st.write("yfinance last 12 index dates:", [pd.to_datetime(x).date().isoformat() for x in h_diag.index[-12:]])
-        else:
-            st.warning("yfinance returned empty history for this window.")
-
-with st.expander("➕ Add or ➖ remove stocks (Git-backed)"):
-    c1, c2 = st.columns([1.2, 1])
-    with c1:
-        st.markdown("**Add a stock**")
-        a_ticker = st.text_input("Ticker (e.g., AAPL, ORSTED.CO)")
-        a_name   = st.text_input("Company name")
-        a_region = st.selectbox("Region", ["Ireland", "UK", "Europe", "US"])
-        a_curr   = st.selectbox("Currency", ["EUR", "GBp", "USD", "DKK", "CHF"])
-        if st.button("Add / Update"):
-            if a_ticker and a_name:
-                db_add_stock(a_ticker, a_name, a_region, a_curr)
-                st.success(f"Saved {a_name} ({a_ticker})")
-                ok,msg = sync_db_to_github("add/update stock")
-                st.info(f"↩︎ {msg}") if ok else st.warning(msg)
-                st.rerun()
+@_fragment
+def diagnostics_panel():
+    with st.expander("🧪 Data diagnostics (Yahoo bars vs yfinance)"):
+        tkr_test = st.text_input("Ticker to inspect", value="A5G.IR")
+        dt_test = st.date_input("Date (on/before)", value=date.today(), key="diag_date")
+        if st.button("Inspect feed"):
+            dcs, meta = _yahoo_chart_series(tkr_test, dt_test - timedelta(days=40), dt_test)
+            if dcs:
+                last12 = dcs[-12:]
+                st.write("Yahoo chart last 12 bar dates:", [d.isoformat() for d, _ in last12])
+                upto = [c for (d, c) in dcs if d <= dt_test]
+                st.write(f"Bars up to {dt_test.isoformat()}: {len(upto)}")
+                st.write("Yahoo 5D % (if available):", yahoo_pct_change_n_bars(tkr_test, dt_test, 5, use_live_when_today=True))
             else:
-                st.warning("Please provide at least Ticker and Company name.")
-    with c2:
-        st.markdown("**Remove stocks**")
-        rem_choices = [f"{r['name']} ({r['ticker']})" for _, r in stocks_df.sort_values("name").iterrows()]
-        rem_sel = st.multiselect("Select to remove", rem_choices, [])
-        if st.button("Remove selected"):
-            tickers = [s[s.rfind("(")+1:-1] for s in rem_sel]
-            db_remove_stocks(tickers)
-            st.success(f"Removed {len(tickers)} stock(s)")
-            ok,msg = sync_db_to_github("remove stocks")
-            st.info(f"↩︎ {msg}") if ok else st.warning(msg)
-            st.rerun()
-
-    st.markdown("---")
-    st.markdown("**Export / import stock list**")
-    try:
-        stocks_now = db_all_stocks().sort_values("name")
-        out = io.StringIO()
-        stocks_now.to_csv(out, index=False)
-        st.download_button("⬇️ Download stocks CSV", out.getvalue(), "stocks.csv", "text/csv")
-    except Exception as e:
-        st.warning(f"Could not export stocks: {e}")
-
-    up_stocks = st.file_uploader("Upload stocks CSV", type=["csv"], key="stocks_csv")
-    if up_stocks is not None:
-        try:
-            df_imp = pd.read_csv(up_stocks, encoding="utf-8-sig", keep_default_na=False)
-            cols = {c.strip().lower(): c for c in df_imp.columns}
-            required = {"ticker","name","region","currency"}
-            if not required.issubset(set(cols.keys())):
-                st.error("CSV must include columns: ticker, name, region, currency")
+                st.warning("No chart bars returned from Yahoo (after retries).")
+
+            h_diag = yf_history(tkr_test, start=dt_test - timedelta(days=20), end=dt_test + timedelta(days=2))
+            if not h_diag.empty:
+                st.write("yfinance last 12 index dates:", [pd.to_datetime(x).date().isoformat() for x in h_diag.index[-12:]])
+                finality = bar_finality(tkr_test, h_diag.tail(3))
+                st.write(f"Bar status ({venue_calendar_code(tkr_test)} calendar):",
+                         {pd.to_datetime(d).date().isoformat(): v for d, v in finality.items()})
             else:
-                tcol, ncol, rcol, ccol = cols["ticker"], cols["name"], cols["region"], cols["currency"]
-                count = 0
-                for _, r in df_imp.iterrows():
-                    t = str(r[tcol]).strip()
-                    n = str(r[ncol]).strip()
-                    rg = str(r[rcol]).strip()
-                    cu = str(r[ccol]).strip()
-                    if t and n and rg and cu:
-                        db_add_stock(t, n, rg, cu)
-                        count += 1
-                st.success(f"Imported/updated {count} stock(s).")
-                ok,msg = sync_db_to_github("stocks import")
+                st.warning("yfinance returned empty history for this window.")
+
+        st.markdown("---")
+        st.markdown("**Universe scan** — chart vs yfinance for every ticker in the stock list")
+        u1, u2 = st.columns([1, 1])
+        with u1:
+            scan_regions = st.multiselect("Regions", REGION_ORDER, REGION_ORDER, key="scan_regions")
+        with u2:
+            scan_window = st.number_input("Window (calendar days back)", min_value=5, max_value=80, value=20, step=5, key="scan_window")
+        scan_indices = st.checkbox("Include indices", value=True, key="scan_indices")
+        if st.button("Scan all feeds"):
+            universe = db_all_stocks()
+            tickers = universe.loc[universe["region"].isin(scan_regions), "ticker"].tolist()
+            if scan_indices:
+                tickers += [i["ticker"] for i in INDEX_DEFS]
+            with st.spinner(f"Scanning {len(tickers)} tickers…"):
+                st.session_state["scan_report"] = scan_feed_discrepancies(tickers, dt_test, int(scan_window))
+        scan_report = st.session_state.get("scan_report")
+        if scan_report is not None:
+            flagged = int((scan_report["issues"] > 0).sum())
+            st.caption(f"{flagged} of {len(scan_report)} tickers have discrepancies (close tolerance {DISCREPANCY_CLOSE_TOL_PCT}%). Click a column header to sort.")
+            st.dataframe(scan_report, use_container_width=True, hide_index=True)
+
+        st.markdown("---")
+        st.markdown("**Price providers** — fallback order per metric and latency (this process)")
+        st.caption(" · ".join(f"{m}: {' → '.join(provider_chain(m)) or '—'}" for m in PROVIDER_ORDER_DEFAULT))
+        prov = provider_stats_table()
+        if prov.empty:
+            st.caption("No provider calls yet.")
+        else:
+            st.dataframe(prov, use_container_width=True, hide_index=True)
+
+        st.markdown("---")
+        st.markdown("**Process-pool compute** — chart decoding + per-ticker bases, in-process vs sharded (synthetic payloads)")
+        if st.button("Run compute benchmark"):
+            with st.spinner("Benchmarking…"):
+                st.session_state["pool_bench"] = pd.DataFrame(compute_pool.benchmark())
+        bench = st.session_state.get("pool_bench")
+        if bench is not None:
+            st.caption(f"Measured on {int(bench['cpus'].iloc[0])} CPU(s); speedup needs more than one.")
+            st.dataframe(bench, use_container_width=True, hide_index=True)
+            st.line_chart(bench.pivot(index="tickers", columns="processes", values="seconds"))
+diagnostics_panel()
+
+@_fragment
+def stock_management_panel():
+    with st.expander("➕ Add or ➖ remove stocks (Git-backed)"):
+        stocks_df = db_all_stocks()
+        c1, c2 = st.columns([1.2, 1])
+        with c1:
+            st.markdown("**Add a stock**")
+            a_ticker = st.text_input("Ticker (e.g., AAPL, ORSTED.CO)")
+            a_name   = st.text_input("Company name")
+            a_region = st.selectbox("Region", ["Ireland", "UK", "Europe", "US"])
+            a_curr   = st.selectbox("Currency", ["EUR", "GBp", "USD", "DKK", "CHF"])
+            if st.button("Add / Update"):
+                if a_ticker and a_name:
+                    db_add_stock(a_ticker, a_name, a_region, a_curr)
+                    st.success(f"Saved {a_name} ({a_ticker})")
+                    ok,msg = sync_db_to_github("add/update stock")
+                    st.info(f"↩︎ {msg}") if ok else st.warning(msg)
+                    st.rerun()
+                else:
+                    st.warning("Please provide at least Ticker and Company name.")
+        with c2:
+            st.markdown("**Remove stocks**")
+            rem_choices = [f"{r['name']} ({r['ticker']})" for _, r in stocks_df.sort_values("name").iterrows()]
+            rem_sel = st.multiselect("Select to remove", rem_choices, [])
+            if st.button("Remove selected"):
+                tickers = [s[s.rfind("(")+1:-1] for s in rem_sel]
+                db_remove_stocks(tickers)
+                st.success(f"Removed {len(tickers)} stock(s)")
+                ok,msg = sync_db_to_github("remove stocks")
                 st.info(f"↩︎ {msg}") if ok else st.warning(msg)
                 st.rerun()
-        except Exception as e:
-            st.exception(e)
-
-with st.expander("🧭 Manual YTD baselines (Git-backed; set once at start of year)"):
-    cur_year = st.number_input("Year", min_value=2000, max_value=2100, value=selected_date.year, step=1)
-    st.caption("Each row defines the baseline price used for YTD % for that ticker in this year. Price should match the series you want to mirror (Yahoo typically uses Close).")
-
-    c1, c2, c3, c4 = st.columns([1.2, 0.8, 0.8, 1])
-    with c1:
-        b_ticker = st.text_input("Ticker (exact)", placeholder="A5G.IR")
-    with c2:
-        b_price = st.text_input("Baseline price", placeholder="e.g. 4.25")
-    with c3:
-        b_series = st.selectbox("Series", ["close","adjclose"])
-    with c4:
-        b_date = st.text_input("Baseline date (optional, yyyy-mm-dd)", placeholder="2024-12-27")
-
-    b_notes = st.text_input("Notes (optional)", placeholder="e.g. Dec 27 close from Yahoo")
-    if st.button("Add / Update baseline"):
-        try:
-            price_val = float(b_price)
-            db_set_reference(b_ticker, int(cur_year), price_val, b_date.strip() or None, b_series, b_notes.strip() or None)
-            st.success(f"Baseline saved for {b_ticker} ({cur_year}): {price_val}")
-            ok,msg = sync_db_to_github("baseline upsert")
-            st.info(f"↩︎ {msg}") if ok else st.warning(msg)
-        except Exception as e:
-            st.error(f"Could not save baseline: {e}")
-
-    st.markdown("**Bulk import / export**")
-    st.caption("Accepted: CSV or Excel. Columns: ticker, year, price, date (optional), series (close|adjclose, optional), notes (optional)")
-
-    def _read_baseline_upload(upfile) -> pd.DataFrame:
-        name = upfile.name.lower()
-        if name.endswith((".xlsx", ".xls")):
-            return pd.read_excel(upfile)
-        upfile.seek(0)
-        raw = upfile.read()
-        text = raw.decode("utf-8-sig", errors="ignore")
-        import csv as _csv
-        try:
-            dialect = _csv.Sniffer().sniff(text[:10000])
-            sep = dialect.delimiter
-        except Exception:
-            sep = ","
-        from io import StringIO
-        return pd.read_csv(StringIO(text), sep=sep, keep_default_na=False)
 
-    up = st.file_uploader("Upload baselines file (CSV or Excel)", type=["csv","xlsx","xls"])
-    if up is not None:
+        st.markdown("---")
+        st.markdown("**Export / import stock list**")
         try:
-            df_imp = _read_baseline_upload(up)
-            cols_norm = {c: c.strip().lower() for c in df_imp.columns}
-            inv = {v: k for k, v in cols_norm.items()}
-            price_key = next((k for k in ["price","baseline","baseline_price"] if k in inv), None)
-            if price_key is None or not {"ticker","year"}.issubset(set(inv)):
-                st.error("File must include at least: ticker, year, price (or baseline/baseline_price)")
-            else:
-                tick = df_imp[inv["ticker"]].astype(str).str.strip()
-                yr   = pd.to_numeric(df_imp[inv["year"]], errors="coerce").astype("Int64")
-                pr   = pd.to_numeric(df_imp[price_key], errors="coerce")
-                dt   = df_imp[inv["date"]]   if "date"   in inv else ""
-                ser  = df_imp[inv["series"]] if "series" in inv else ""
-                nts  = df_imp[inv["notes"]]  if "notes"  in inv else ""
-
-                norm = pd.DataFrame({
-                    "ticker": tick,
-                    "year": yr,
-                    "price": pr,
-                    "date": dt,
-                    "series": ser,
-                    "notes": nts,
-                })
+            stocks_now = db_all_stocks().sort_values("name")
+            out = io.StringIO()
+            stocks_now.to_csv(out, index=False)
+            st.download_button("⬇️ Download stocks CSV", out.getvalue(), "stocks.csv", "text/csv")
+        except Exception as e:
+            st.warning(f"Could not export stocks: {e}")
 
-                bad = norm[norm[["ticker","year","price"]].isna().any(axis=1) | (norm["ticker"] == "")]
-                if not bad.empty:
-                    st.warning(f"Dropped {len(bad)} invalid row(s) (missing ticker/year/price).")
-
-                norm = norm[(norm["ticker"] != "") & norm["year"].notna() & norm["price"].notna()]
-                okcnt = 0
-                for _, r in norm.iterrows():
-                    db_set_reference(
-                        r["ticker"], int(r["year"]), float(r["price"]),
-                        (None if pd.isna(r["date"]) or str(r["date"]).strip()=="" else str(r["date"])),
-                        (None if pd.isna(r["series"]) or str(r["series"]).strip()=="" else str(r["series"])),
-                        (None if pd.isna(r["notes"]) or str(r["notes"]).strip()=="" else str(r["notes"]))
-                    )
-                    okcnt += 1
-                st.success(f"Imported/updated {okcnt} baseline(s).")
-                if okcnt > 0:
-                    ok,msg = sync_db_to_github("baseline import")
+        up_stocks = st.file_uploader("Upload stocks CSV", type=["csv"], key="stocks_csv")
+        if up_stocks is not None:
+            try:
+                df_imp = pd.read_csv(up_stocks, encoding="utf-8-sig", keep_default_na=False)
+                cols = {c.strip().lower(): c for c in df_imp.columns}
+                required = {"ticker","name","region","currency"}
+                if not required.issubset(set(cols.keys())):
+                    st.error("CSV must include columns: ticker, name, region, currency")
+                else:
+                    tcol, ncol, rcol, ccol = cols["ticker"], cols["name"], cols["region"], cols["currency"]
+                    count = 0
+                    for _, r in df_imp.iterrows():
+                        t = str(r[tcol]).strip()
+                        n = str(r[ncol]).strip()
+                        rg = str(r[rcol]).strip()
+                        cu = str(r[ccol]).strip()
+                        if t and n and rg and cu:
+                            db_add_stock(t, n, rg, cu)
+                            count += 1
+                    st.success(f"Imported/updated {count} stock(s).")
+                    ok,msg = sync_db_to_github("stocks import")
                     st.info(f"↩︎ {msg}") if ok else st.warning(msg)
-        except Exception as e:
-            st.exception(e)
-
-    refs_df = db_all_references(cur_year).sort_values(["ticker","year"])
-    st.dataframe(refs_df, use_container_width=True)
-    if not refs_df.empty:
-        out_csv = io.StringIO()
-        refs_df.to_csv(out_csv, index=False)
-        st.download_button("⬇️ Download current year's baselines CSV", data=out_csv.getvalue(), file_name=f"ytd_baselines_{cur_year}.csv", mime="text/csv")
-
-    if not refs_df.empty:
-        del_opts = [f"{r['ticker']} ({r['year']})" for _, r in refs_df.iterrows()]
-        del_sel = st.multiselect("Delete baselines", del_opts, [])
-        if st.button("Delete selected baselines"):
-            keys = []
-            for s_ in del_sel:
-                t = s_[:s_.rfind("(")].strip()
-                y = int(s_[s_.rfind("(")+1:-1])
-                keys.append((t,y))
-            db_delete_references(keys)
-            st.success(f"Deleted {len(keys)} baseline(s).")
-            ok,msg = sync_db_to_github("baseline delete")
-            st.info(f"↩︎ {msg}") if ok else st.warning(msg)
-            st.rerun()
+                    st.rerun()
+            except Exception as e:
+                st.exception(e)
+stock_management_panel()
+
+@_fragment
+def baselines_panel(default_year: int):
+    with st.expander("🧭 Manual YTD baselines (Git-backed; set once at start of year)"):
+        cur_year = st.number_input("Year", min_value=2000, max_value=2100, value=default_year, step=1)
+        st.caption("Each row defines the baseline price used for YTD % for that ticker in this year. Price should match the series you want to mirror (Yahoo typically uses Close).")
+
+        c1, c2, c3, c4 = st.columns([1.2, 0.8, 0.8, 1])
+        with c1:
+            b_ticker = st.text_input("Ticker (exact)", placeholder="A5G.IR")
+        with c2:
+            b_price = st.text_input("Baseline price", placeholder="e.g. 4.25")
+        with c3:
+            b_series = st.selectbox("Series", ["close","adjclose"])
+        with c4:
+            b_date = st.text_input("Baseline date (optional, yyyy-mm-dd)", placeholder="2024-12-27")
+
+        b_notes = st.text_input("Notes (optional)", placeholder="e.g. Dec 27 close from Yahoo")
+        if st.button("Add / Update baseline"):
+            try:
+                price_val = float(b_price)
+                db_set_reference(b_ticker, int(cur_year), price_val, b_date.strip() or None, b_series, b_notes.strip() or None)
+                st.success(f"Baseline saved for {b_ticker} ({cur_year}): {price_val}")
+                ok,msg = sync_db_to_github("baseline upsert")
+                st.info(f"↩︎ {msg}") if ok else st.warning(msg)
+            except Exception as e:
+                st.error(f"Could not save baseline: {e}")
+
+        st.markdown("**Generate from market data**")
+        st.caption("Derives a baseline for every ticker in the stock list: official last session of the previous year (cached bars), else Yahoo's chart feed. Existing entries are only replaced when you tick overwrite.")
+        g1, g2 = st.columns([1, 1])
+        with g1:
+            gen_overwrite = st.checkbox("Overwrite entries that differ", value=False, key="gen_overwrite")
+        with g2:
+            gen_series_close = st.checkbox("Use Close (uncheck for Adj Close)", value=True, key="gen_series_close")
+        if st.button(f"⚙️ Generate {int(cur_year)} baselines"):
+            with st.spinner("Deriving baselines…"):
+                report = generate_year_baselines(int(cur_year), use_price_return=gen_series_close)
+            written = write_year_baselines(report, int(cur_year), overwrite=gen_overwrite)
+            counts = report["status"].value_counts().to_dict()
+            st.success(f"Wrote {written} baseline(s). " + ", ".join(f"{k}: {v}" for k, v in counts.items()))
+            st.dataframe(
+                report.sort_values(["status", "ticker"]).round({"price": 4, "existing_price": 4, "diff_pct": 3}),
+                use_container_width=True,
+            )
+            if written:
+                ok,msg = sync_db_to_github(f"baselines generated for {int(cur_year)}")
+                st.info(f"↩︎ {msg}") if ok else st.warning(msg)
+
+        st.markdown("**Bulk import / export**")
+        st.caption("Accepted: CSV or Excel. Columns: ticker, year, price, date (optional), series (close|adjclose, optional), notes (optional)")
+
+        def _read_baseline_upload(upfile) -> pd.DataFrame:
+            name = upfile.name.lower()
+            if name.endswith((".xlsx", ".xls")):
+                return pd.read_excel(upfile)
+            upfile.seek(0)
+            raw = upfile.read()
+            text = raw.decode("utf-8-sig", errors="ignore")
+            import csv as _csv
+            try:
+                dialect = _csv.Sniffer().sniff(text[:10000])
+                sep = dialect.delimiter
+            except Exception:
+                sep = ","
+            from io import StringIO
+            return pd.read_csv(StringIO(text), sep=sep, keep_default_na=False)
+
+        up = st.file_uploader("Upload baselines file (CSV or Excel)", type=["csv","xlsx","xls"])
+        if up is not None:
+            try:
+                df_imp = _read_baseline_upload(up)
+                cols_norm = {c: c.strip().lower() for c in df_imp.columns}
+                inv = {v: k for k, v in cols_norm.items()}
+                price_key = next((k for k in ["price","baseline","baseline_price"] if k in inv), None)
+                if price_key is None or not {"ticker","year"}.issubset(set(inv)):
+                    st.error("File must include at least: ticker, year, price (or baseline/baseline_price)")
+                else:
+                    tick = df_imp[inv["ticker"]].astype(str).str.strip()
+                    yr   = pd.to_numeric(df_imp[inv["year"]], errors="coerce").astype("Int64")
+                    pr   = pd.to_numeric(df_imp[price_key], errors="coerce")
+                    dt   = df_imp[inv["date"]]   if "date"   in inv else ""
+                    ser  = df_imp[inv["series"]] if "series" in inv else ""
+                    nts  = df_imp[inv["notes"]]  if "notes"  in inv else ""
+
+                    norm = pd.DataFrame({
+                        "ticker": tick,
+                        "year": yr,
+                        "price": pr,
+                        "date": dt,
+                        "series": ser,
+                        "notes": nts,
+                    })
+
+                    bad = norm[norm[["ticker","year","price"]].isna().any(axis=1) | (norm["ticker"] == "")]
+                    if not bad.empty:
+                        st.warning(f"Dropped {len(bad)} invalid row(s) (missing ticker/year/price).")
+
+                    norm = norm[(norm["ticker"] != "") & norm["year"].notna() & norm["price"].notna()]
+                    okcnt = 0
+                    for _, r in norm.iterrows():
+                        db_set_reference(
+                            r["ticker"], int(r["year"]), float(r["price"]),
+                            (None if pd.isna(r["date"]) or str(r["date"]).strip()=="" else str(r["date"])),
+                            (None if pd.isna(r["series"]) or str(r["series"]).strip()=="" else str(r["series"])),
+                            (None if pd.isna(r["notes"]) or str(r["notes"]).strip()=="" else str(r["notes"]))
+                        )
+                        okcnt += 1
+                    st.success(f"Imported/updated {okcnt} baseline(s).")
+                    if okcnt > 0:
+                        ok,msg = sync_db_to_github("baseline import")
+                        st.info(f"↩︎ {msg}") if ok else st.warning(msg)
+            except Exception as e:
+                st.exception(e)
+
+        refs_df = db_all_references(cur_year).sort_values(["ticker","year"])
+        st.dataframe(refs_df, use_container_width=True)
+        if not refs_df.empty:
+            out_csv = io.StringIO()
+            refs_df.to_csv(out_csv, index=False)
+            st.download_button("⬇️ Download current year's baselines CSV", data=out_csv.getvalue(), file_name=f"ytd_baselines_{cur_year}.csv", mime="text/csv")
+
+        if not refs_df.empty:
+            del_opts = [f"{r['ticker']} ({r['year']})" for _, r in refs_df.iterrows()]
+            del_sel = st.multiselect("Delete baselines", del_opts, [])
+            if st.button("Delete selected baselines"):
+                keys = []
+                for s_ in del_sel:
+                    t = s_[:s_.rfind("(")].strip()
+                    y = int(s_[s_.rfind("(")+1:-1])
+                    keys.append((t,y))
+                db_delete_references(keys)
+                st.success(f"Deleted {len(keys)} baseline(s).")
+                ok,msg = sync_db_to_github("baseline delete")
+                st.info(f"↩︎ {msg}") if ok else st.warning(msg)
+                _rerun_panel()
+baselines_panel(selected_date.year)
 
 stocks_df = db_all_stocks()
 stock_options = {f"{r['name']} ({r['ticker']})": dict(r) for _, r in stocks_df.iterrows()}
@@ -957,124 +3362,133 @@ sel_labels = st.multiselect(
 selected_stocks = [stock_options[label] for label in sel_labels]
 
 # -----------------------------
-# Run calculation
+# Run calculation (full precision; cached per run parameters)
 # -----------------------------
+target_date = pd.to_datetime(selected_date).date()
+run_key = run_params_key(
+    target_date,
+    [s["ticker"] for s in selected_stocks],
+    exact_yahoo_mode=exact_yahoo_mode,
+    use_manual_baselines=use_manual_baselines,
+    use_official_calendars=use_official_calendars,
+    show_indices=show_indices,
+    extra_horizons=bool(extra_horizons),
+)
+# An explicit Run always recomputes (baselines may have been edited since); passive
+# reruns can pick up a fresh result another session computed for the same parameters,
+# or on a fresh container the final rows stored in the result history.
+result = None
+if not run and not cassette_active() and run_key not in st.session_state.get("run_results", {}):
+    result = run_result_lookup(run_key)
+    if result is not None:
+        debug("**Served from result cache**")
+    elif history_enabled():
+        result = history_result(run_key, [s["ticker"] for s in selected_stocks], target_date)
+        if result is not None:
+            debug("**Served from result history**")
+    if result is not None:
+        remember_session_result(run_key, result)
+
 if run:
     rows = []
-    target_dt = pd.to_datetime(selected_date)
-    target_date = target_dt.date()
     today_date = date.today()
-    
+
     debug(f"**DEBUG: target_date = {target_date}, today = {today_date}**")
     debug(f"**Selected {len(selected_stocks)} stocks**")
 
+    set_fetch_deadline(fetch_budget_s)
+    skipped_deadline = []
+    idx_rows = []
+    idx_series = {}
+    span_from = horizon_span_start(target_date) if extra_horizons else None
+    close_matrix = {"": {}, TR_SUFFIX: {}}  # flavour suffix -> {ticker: closes}
+    target_day = day_number(target_date)
+    prev_year_end_day = day_number(date(selected_date.year - 1, 12, 31))
+
     # --------- Stocks ----------
-    for s in selected_stocks:
+    ctx = {
+        "target_date": target_date,
+        "year": selected_date.year,
+        "span_from": span_from,
+        "exact_yahoo_mode": exact_yahoo_mode,
+        "use_manual_baselines": use_manual_baselines,
+        "use_official_calendars": use_official_calendars,
+    }
+    retry_stocks = []  # failed or empty: placeholder rows now, background retries later
+    progress_box = st.empty()
+    progress_total = len(selected_stocks) + (len(INDEX_DEFS) if show_indices else 0)
+    progress_t0 = time.perf_counter()
+    progress_drawn = [0.0, 0]  # last redraw time, rows shown then
+
+    def progress_tick(done: int, force: bool = False):
+        """Redraw when forced, when the first row lands, or every PROGRESS_REDRAW_S."""
+        now = time.perf_counter()
+        first_row = rows and not progress_drawn[1]
+        if force or first_row or now - progress_drawn[0] >= PROGRESS_REDRAW_S:
+            progress_render(progress_box, rows, done, progress_total, progress_t0, use_price_return, DP)
+            progress_drawn[:] = [now, len(rows)]
+
+    progress_tick(0, force=True)
+    # Process-pool mode: fetch raw chart payloads first, then decode them and compute
+    # bases in one sharded pass; tickers it could not serve take the per-ticker path
+    pooled = {}
+    if (compute_processes > 1 and len(selected_stocks) >= compute_pool.POOL_MIN_TICKERS
+            and "yahoo_chart" in provider_chain("bars")):
+        pooled = pool_stock_inputs(selected_stocks, ctx, compute_processes)
+        debug(f"Process-pool stage: {len(pooled)}/{len(selected_stocks)} tickers decoded on {compute_processes} processes")
+    for done, s in enumerate(selected_stocks):
+        progress_tick(done)
         tkr = s["ticker"]
+        if tkr not in pooled and fetch_deadline_passed():
+            skipped_deadline.append(tkr)
+            continue
         debug(f"**Processing {tkr}...**")
         try:
-            hist = yf.download(
-                tkr,
-                start=f"{selected_date.year-1}-12-15",
-                end=selected_date + timedelta(days=7),
-                progress=False,
-                auto_adjust=False,
-            )
-            debug(f"yfinance returned {len(hist)} rows")
-            debug(f"hist type: {type(hist)}")
-            debug(f"hist.empty: {hist.empty if hasattr(hist, 'empty') else 'N/A'}")
-            
-            if hist.empty:
-                debug("✗ SKIP: hist is empty")
+            inputs = pooled.get(tkr) or fetch_stock_inputs(s, ctx)
+            if inputs is None:
+                debug("✗ RETRY LATER: no bars returned")
+                retry_stocks.append(s)
                 continue
-
+            hist = inputs["hist"]
+            debug(f"fetch plan: {[(w0.isoformat(), w1.isoformat()) for w0, w1 in inputs['windows']]}")
+            debug(f"{inputs['src']} returned {len(hist)} rows")
             debug(f"hist index dates: {[str(d.date()) for d in hist.index[-5:]]}")
-            
-            price_eod, pos = last_close_on_or_before_date(hist, target_date, use_price_return)
-            debug(f"last_close_on_or_before_date returned: price_eod={price_eod}, pos={pos}")
-            
-            if pos is None:
-                debug("✗ SKIP: pos is None")
+            if span_from is not None:
+                close_matrix[""][tkr] = _close_series(hist, "Close")
+                close_matrix[TR_SUFFIX][tkr] = _close_series(hist, "Adj Close")
+
+            bases = inputs.get("bases")
+            if bases is None:
+                bases = ticker_bases(inputs["days"], inputs["closes"], target_day, 5, inputs["baseline_day"],
+                                     prev_year_end_day, inputs["window_day"])
+            row = stock_row(s, bases, inputs["manual_ref"], target_date, selected_date.year, exact_yahoo_mode)
+            if row is None:
+                debug("✗ RETRY LATER: no close on or before target date")
+                retry_stocks.append(s)
                 continue
-            
-            debug(f"✓ SUCCESS: Have price={price_eod}, pos={pos}")
-            
-            use_live = use_price_return and (target_date == today_date)
-            live_price = None
-            if use_live:
-                try:
-                    fi = yf.Ticker(tkr).fast_info
-                    live_price = fi.get("last_price") or fi.get("regular_market_price")
-                except Exception:
-                    live_price = None
-
-            price_num = float(live_price) if (live_price is not None) else float(price_eod)
-
-            chg_5d = None
-            if exact_yahoo_mode:
-                chg_5d = yahoo_pct_change_n_bars(tkr, target_date, 5, use_live_when_today=use_price_return)
-            if chg_5d is None:
-                c_5ago = close_n_trading_days_ago_by_pos(hist, pos, 5, use_price_return)
-                if c_5ago is not None and c_5ago != 0:
-                    chg_5d = (price_num - c_5ago) / c_5ago * 100.0
-
-            manual_used = False
-            chg_ytd = None
-
-            manual_ref = db_get_reference(tkr, selected_date.year) if use_manual_baselines else None
-            if manual_ref is not None:
-                base = float(manual_ref["price"])
-                chg_ytd = (price_num - base) / base * 100.0
-                manual_used = True
-            else:
-                base_val = None
-                if use_official_calendars and _HAS_XCALS:
-                    baseline_session = official_prev_year_last_session(tkr, selected_date.year)
-                    if baseline_session is not None:
-                        base_val = baseline_from_hist_on_or_before(hist, baseline_session, use_price_return)
-                if base_val is not None and base_val != 0:
-                    chg_ytd = (price_num - float(base_val)) / float(base_val) * 100.0
-                else:
-                    if exact_yahoo_mode:
-                        chg_ytd = yahoo_ytd_via_chart(tkr, selected_date.year, target_date, use_live_when_today=use_price_return)
-                    else:
-                        dates = _session_dates_index(hist)
-                        mask_prev = dates <= date(selected_date.year - 1, 12, 31)
-                        base_fallback = float(hist.iloc[np.where(mask_prev)[0][-1]][_col(use_price_return)]) if mask_prev.any() else None
-                        chg_ytd = ((price_num - base_fallback) / base_fallback * 100.0) if base_fallback else None
-
-            rows.append({
-                "Company": s["name"],
-                "Manual": "🧭" if manual_used else "",
-                "Region": s["region"],
-                "Currency": s["currency"],
-                "Price": round(price_num, DP),
-                "5D % Change": round(chg_5d, DP) if chg_5d is not None else None,
-                "YTD % Change": round(chg_ytd, DP) if chg_ytd is not None else None,
-            })
+            debug(f"✓ SUCCESS: price={row['Price']}, total-return price={row[f'Price{TR_SUFFIX}']}")
+            rows.append(row)
         except Exception as e:
-            debug(f"✗ ERROR: {type(e).__name__}: {e}")
+            debug(f"✗ RETRY LATER: {type(e).__name__}: {e}")
+            retry_stocks.append(s)
             continue
 
+    for s in retry_stocks:
+        rows.append({
+            "Ticker": s["ticker"], "Company": s["name"], "Manual": "",
+            "Region": s["region"], "Currency": s["currency"], "Status": STATUS_PENDING,
+            **{f"{c}{sfx}": None for c in ("Price", "5D % Change", "YTD % Change") for sfx in ("", TR_SUFFIX)},
+        })
+
     # --------- Indices ----------
     if show_indices:
-        idx_defs = [
-            {"name": "ISEQ All-Share", "ticker": "^ISEQ"},
-            {"name": "FTSE 100",       "ticker": "^FTSE"},
-            {"name": "S&P 500",        "ticker": "^GSPC"},
-            {"name": "DAX",            "ticker": "^GDAXI"},
-        ]
-        chart_cols = st.columns(len(idx_defs)) if show_index_charts else None
-        idx_rows = []
-        for i, info in enumerate(idx_defs):
+        for i, info in enumerate(INDEX_DEFS):
+            progress_tick(len(selected_stocks) + i)
+            if fetch_deadline_passed():
+                skipped_deadline.append(info["ticker"])
+                continue
             try:
-                h = yf.download(
-                    info["ticker"],
-                    start=selected_date - timedelta(days=30),
-                    end=selected_date + timedelta(days=7),
-                    progress=False,
-                    auto_adjust=False,
-                )
+                h, _ = provider_call("bars", info["ticker"], plan_fetch_windows(info["ticker"], target_date, n_back=10, need_ytd=False))
                 if h is None or h.empty:
                     continue
 
@@ -1084,77 +3498,243 @@ if run:
 
                 chg_5d_idx = None
                 if exact_yahoo_mode:
-                    chg_5d_idx = yahoo_pct_change_n_bars(info["ticker"], target_date, 5, use_live_when_today=True)
+                    chg_5d_idx, _ = provider_call("pct_5d", info["ticker"], target_date, True)
                 if chg_5d_idx is None:
                     lvl_5ago = close_n_trading_days_ago_by_pos(h, pos_lvl, 5, use_price_return=True)
                     if lvl_5ago is not None and lvl_5ago != 0:
                         chg_5d_idx = (last_lvl - lvl_5ago) / lvl_5ago * 100.0
 
                 idx_rows.append({
+                    "Ticker": info["ticker"],
                     "Index": info["name"],
-                    "Level": round(last_lvl, DP),
-                    "5D % Change": round(chg_5d_idx, DP) if chg_5d_idx is not None else None,
+                    "Level": last_lvl,
+                    "5D % Change": chg_5d_idx,
                 })
-
-                if show_index_charts:
-                    series = h["Close"].dropna().tail(10)
-                    with chart_cols[i]:
-                        st.caption(info["name"])
-                        st.line_chart(series)
+                idx_series[info["name"]] = h["Close"].dropna().tail(10)
             except Exception:
                 continue
 
-        if idx_rows:
-            st.subheader("Major indices — 5-day trend")
-            st.dataframe(pd.DataFrame(idx_rows), use_container_width=True)
-
-    # --------- Stocks table / CSV ----------
-    if not rows:
-        st.warning("No stock data available for that date.")
+    progress_box.empty()
+    set_fetch_deadline(None)
+    if DEBUG_MODE:
+        debug(yahoo_host_status())
+        debug(f"Shared cache: {shared_cache_stats()}")
+        debug("Rate limiter (per host):")
+        debug(rate_limiter_status())
+        debug(provider_stats_table())
+        if _warmer is not None:
+            debug(f"Cache warmer next wake: {_warmer['next_wake']}")
+            debug(_warmer["log"][-10:])
+
+    rows_df = pd.DataFrame(rows)
+    if not rows_df.empty:
+        rows_df["Status"] = rows_df["Status"].fillna("") if "Status" in rows_df.columns else ""
+    if span_from is not None and not rows_df.empty:
+        cal_codes = {t: venue_calendar_code(t) for t in rows_df["Ticker"]}
+        for sfx, closes in close_matrix.items():
+            hz = horizon_returns(pd.DataFrame(closes), rows_df.set_index("Ticker")[f"Price{sfx}"], target_date, cal_codes)
+            rows_df = rows_df.join(hz.add_suffix(sfx), on="Ticker")
+    if history_enabled():
+        queued = history_append(run_key, rows_df)
+        debug(f"Result history: queued {queued} row(s); {history_pending()} pending, committed in the background")
+
+    # FX for the base-currency view, fetched once here (keyed by base) so the
+    # render never touches the network; another base needs another Run
+    fx_rates = {}
+    if fx_base != "Local" and not rows_df.empty:
+        fx_rates[fx_base] = fx_rates_for_run(fx_listing_keys(rows_df), fx_base, target_date)
+
+    result = {
+        "target_date": target_date,
+        "rows": rows_df,
+        "fx": fx_rates,
+        "idx": pd.DataFrame(idx_rows),
+        "idx_series": idx_series,
+        "skipped": skipped_deadline,
+        "budget_s": fetch_budget_s,
+    }
+    retry_enqueue(run_key, retry_stocks, ctx)
+    if cassette_active():
+        saved = cassette_save()
+        if saved:
+            debug(f"**Cassette saved to {saved}**")
     else:
-        df = (
-            pd.DataFrame(rows)
-              .sort_values(by=["Region", "Company"])
-              .reset_index(drop=True)
-        )
-
-        region_order = ["Ireland", "UK", "Europe", "US"]
-        df["Region"] = pd.Categorical(df["Region"], categories=region_order, ordered=True)
-        df = df.sort_values(["Region", "Company"])
+        run_result_store(run_key, result)
+    remember_session_result(run_key, result)
 
-        display_cols = ["Company","Manual","Price","5D % Change","YTD % Change"]
+# -----------------------------
+# Render (pure formatting of the cached result; no network, no recompute)
+# -----------------------------
+IDX_DISPLAY_COLS = ["Index", "Level", "5D % Change"]
 
-        for region in region_order:
-            g = df[df["Region"] == region]
-            if g.empty:
-                continue
-            currs = g["Currency"].unique().tolist()
-            curr_label = " / ".join(currency_symbol(c) for c in currs if currency_symbol(c))
-            header = f"{region} ({curr_label})" if curr_label else region
-            st.subheader(header)
-            st.dataframe(g[display_cols], use_container_width=True)
-
-        REGION_LABELS = {
-            "Ireland": f"Ireland ({currency_symbol('EUR')})",
-            "UK":      f"UK (GBX)",
-            "Europe":  f"Europe ({currency_symbol('EUR')})",
-            "US":      f"US ({currency_symbol('USD')})",
+def return_view(rows: pd.DataFrame, use_price_return: bool, show_both: bool, horizons=()):
+    """
+    Pick the shown return flavour from a Run's rows (both are always stored):
+    the chosen one under the usual Price/5D/YTD names, plus the selected
+    extra horizons and, when show_both, the other flavour's % columns.
+    Returns (df, extra column names).
+    """
+    hz = [horizon_col(h) for h in horizons if horizon_col(h) in rows.columns]
+    pr = ["Price", "5D % Change", "YTD % Change"] + hz
+    tr = [c + TR_SUFFIX for c in pr]
+    if not set(tr) <= set(rows.columns):
+        return rows, hz
+    src, alt, alt_label = (pr, tr, "TR") if use_price_return else (tr, pr, "PR")
+    df = rows.drop(columns=[c for c in rows.columns if c in pr or c.endswith(TR_SUFFIX)])
+    for name, col in zip(pr, src):
+        df[name] = rows[col]
+    extra = list(hz)
+    if show_both:
+        for name, col in zip(pr[1:], alt[1:]):
+            label = f"{name.replace(' Change', '')} ({alt_label})"
+            df[label] = rows[col]
+            extra.append(label)
+    return df, extra
+
+def live_tick(run_key: tuple, result: dict) -> dict:
+    """
+    One live refresh: copy the cached result once per session (cached results
+    are shared), derive fixed 5D/YTD baselines once per return flavour, then
+    re-fetch only the batched last prices and recompute the cells that moved.
+    A last price is a price-return quote; the total-return columns move with it
+    scaled by the row's adjustment factor (TR price / price), so each flavour
+    stays on its own basis. If the batch fetch fails the tick keeps last values.
+    """
+    t0 = time.perf_counter()
+    live = st.session_state.setdefault("live_results", {})
+    state = live.get(run_key)
+    if state is None:
+        rows = result["rows"].copy()
+        idx = result["idx"].copy()
+        flavours = {}
+        if not rows.empty:
+            for sfx in ("", TR_SUFFIX):
+                if f"Price{sfx}" in rows.columns:
+                    pct = [c for c in rows.columns if c.endswith("% Change" + sfx)]
+                    factor = pd.to_numeric(rows[f"Price{sfx}"], errors="coerce") / pd.to_numeric(rows["Price"], errors="coerce")
+                    flavours[sfx] = (live_bases(rows, f"Price{sfx}", pct), dict(zip(rows["Ticker"], factor)))
+        state = {
+            "result": {**result, "rows": rows, "idx": idx},
+            "row_bases": flavours,
+            "idx_bases": live_bases(idx, "Level", ["5D % Change"]) if not idx.empty else None,
         }
+        live.clear()
+        live[run_key] = state
+    res = state["result"]
+    symbols = (res["rows"]["Ticker"].tolist() if not res["rows"].empty else []) + \
+              (res["idx"]["Ticker"].tolist() if not res["idx"].empty else [])
+    prices = batch_last_prices(symbols)
+    changed = 0
+    for sfx, (bases, factor) in state["row_bases"].items():
+        flavour_prices = {t: p * factor[t] for t, p in prices.items() if pd.notna(factor.get(t))}
+        n = apply_live_prices(res["rows"], bases, flavour_prices, f"Price{sfx}")
+        changed += n if sfx == "" else 0
+    if state["idx_bases"] is not None:
+        changed += apply_live_prices(res["idx"], state["idx_bases"], prices, "Level")
+    res["live_at"] = datetime.now()
+    res["live_changed"] = changed
+    res["live_missed"] = len(set(symbols) - set(prices))
+    res["live_ms"] = (time.perf_counter() - t0) * 1000.0
+    return res
+
+def results_panel(run_key: tuple, result: Optional[dict]):
+    if result is None:
+        result = st.session_state.get("run_results", {}).get(run_key)
+
+    retry_version = 0
+    if result is not None:
+        rows, retry_left, retry_version = retry_merge(run_key, result["rows"])
+        result = {**result, "rows": rows}
+        if retry_left:
+            st.caption(f"{STATUS_PENDING}: retrying {retry_left} ticker(s) in the background…")
+        elif _retry_polling:
+            st.rerun()  # retries settled: full rerun stops the polling refresh
+
+    if result is not None and live_mode and result["target_date"] == date.today():
+        result = live_tick(run_key + (("retry", retry_version),), result)
+
+    if result is not None:
+        target_date = result["target_date"]
+        if result.get("live_at"):
+            missed = f", {result['live_missed']} unavailable (last values kept)" if result.get("live_missed") else ""
+            st.caption(f"🟢 Live — last prices at {result['live_at']:%H:%M:%S} ({result['live_changed']} changed{missed}, {result['live_ms']:.0f} ms)")
+        if result.get("from_history"):
+            st.caption("🗂️ Stock rows from the result history (indices are not stored) — press Run to recompute.")
+        if result["skipped"]:
+            st.warning(
+                f"Fetch budget of {result['budget_s']}s reached — showing partial results. "
+                f"Skipped {len(result['skipped'])}: {', '.join(result['skipped'])}"
+            )
+
+        idx_df = result["idx"]
+        if show_indices and not idx_df.empty:
+            if show_index_charts and result["idx_series"]:
+                chart_cols = st.columns(len(result["idx_series"]))
+                for col, (name, series) in zip(chart_cols, result["idx_series"].items()):
+                    with col:
+                        st.caption(name)
+                        st.line_chart(series)
+            st.subheader("Major indices — 5-day trend")
+            st.dataframe(idx_df[IDX_DISPLAY_COLS].round(DP), use_container_width=True)
 
-        output = io.StringIO()
-        writer = csv.writer(output, quoting=csv.QUOTE_MINIMAL)
+        # --------- Stocks table / CSV ----------
+        rows_df = result["rows"]
+        if rows_df.empty:
+            st.warning("No stock data available for that date.")
+        else:
+            df = (
+                rows_df
+                  .sort_values(by=["Region", "Company"])
+                  .reset_index(drop=True)
+            )
 
-        for region in region_order:
-            g = df[df["Region"] == region]
-            if g.empty:
-                continue
-            writer.writerow([REGION_LABELS[region], "Last price", "5D % change", "YTD % change"])
-            for _, row in g.iterrows():
-                company = (row["Company"] or "").replace(",", "")
-                price = (price_fmt.format(row['Price'])) if pd.notnull(row["Price"]) else ""
-                c5 = (pct_fmt.format(row['5D % Change'])) if pd.notnull(row["5D % Change"]) else ""
-                cy = (pct_fmt.format(row['YTD % Change'])) if pd.notnull(row['YTD % Change']) else ""
-                writer.writerow([company, price, c5, cy])
-
-        csv_bytes = "\ufeff" + output.getvalue()
-        st.download_button("💾 Download CSV", csv_bytes, "stock_data.csv", "text/csv")
+            region_order = REGION_ORDER
+            df["Region"] = pd.Categorical(df["Region"], categories=region_order, ordered=True)
+            df = df.sort_values(["Region", "Company"])
+            df, ret_cols = return_view(df, use_price_return, show_both_returns, extra_horizons)
+
+            display_cols = ["Company","Manual","Price","5D % Change","YTD % Change"] + ret_cols
+            if "Status" in df.columns and (df["Status"] != "").any():
+                display_cols.append("Status")
+            fx_cols = []
+            fx = result.get("fx", {}).get(fx_base) if fx_base != "Local" else None
+            if fx_base != "Local" and fx is None:
+                st.info(f"{fx_base} FX rates are fetched by a Run — press Run to add the {fx_base} columns.")
+            elif fx is not None:
+                keys = fx_listing_keys(df)
+                missing_fx = sorted(set(keys[fx.reindex(keys).isna().any(axis=1).to_numpy()].get_level_values(0)))
+                if missing_fx:
+                    st.warning(f"No {fx_base} FX rate for: {', '.join(missing_fx)}")
+                df = apply_fx_view(df, fx, fx_base)
+                fx_cols = [f"Price ({fx_base})", f"5D % ({fx_base})", f"YTD % ({fx_base})"]
+                display_cols += fx_cols
+
+            for region in region_order:
+                g = df[df["Region"] == region]
+                if g.empty:
+                    continue
+                currs = g["Currency"].unique().tolist()
+                curr_label = " / ".join(currency_symbol(c) for c in currs if currency_symbol(c))
+                header = f"{region} ({curr_label})" if curr_label else region
+                st.subheader(header)
+                st.dataframe(g[display_cols].round(DP), use_container_width=True)
+
+            exports = build_exports(df, idx_df[IDX_DISPLAY_COLS] if show_indices and not idx_df.empty else pd.DataFrame(), DP, target_date.isoformat(), tuple(ret_cols + fx_cols))
+            d1, d2, d3 = st.columns(3)
+            with d1:
+                st.download_button("💾 Download CSV", exports["csv"], "stock_data.csv", "text/csv")
+            with d2:
+                st.download_button(
+                    "📗 Download Excel", exports["xlsx"], f"stock_data_{target_date.isoformat()}.xlsx",
+                    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                )
+            with d3:
+                st.download_button("🧾 Download JSON", exports["json"], f"stock_data_{target_date.isoformat()}.json", "application/json")
+    elif st.session_state.get("run_results"):
+        st.info("Run parameters changed — press Run to compute this selection.")
+
+# Poll only while the rows this panel shows still hold pending placeholders.
+_shown = result if result is not None else st.session_state.get("run_results", {}).get(run_key)
+_retry_polling = _shown is not None and retry_merge(run_key, _shown["rows"])[1] > 0
+_panel_every = f"{live_interval_s}s" if live_mode else (f"{RETRY_POLL_S}s" if _retry_polling else None)
+_fragment(run_every=_panel_every)(results_panel)(run_key, result)
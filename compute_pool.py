@@ -0,0 +1,201 @@
+# compute_pool.py
+"""
+Chart decoding and per-ticker bar computations for a Run, optionally sharded
+across processes.
+
+Kept out of app.py because Streamlit executes the app as __main__, which pool
+workers cannot import. Workers get raw chart payloads (bytes, as fetched) and
+return plain numpy arrays concatenated per shard, so neither JSON trees nor
+DataFrames cross the process boundary.
+
+Run `python compute_pool.py` for the scaling benchmark.
+"""
+import os
+import json
+import time
+import multiprocessing
+from datetime import date
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+# Columns of the closes array and, per flavour, the bases ticker_bases returns.
+FLAVOURS = ["Close", "Adj Close"]
+BASE_FIELDS = ["price", "base_5d", "base_official", "base_prev_year"]
+POOL_MIN_TICKERS = 200   # below this the pool's IPC costs more than it saves
+SHARDS_PER_PROCESS = 4
+
+_EPOCH = date(1970, 1, 1)
+
+def day_number(d: date) -> int:
+    """Days since 1970-01-01 (the unit of the `days` arrays)."""
+    return (d - _EPOCH).days
+
+def ticker_bases(days: np.ndarray, closes: np.ndarray, target_day: int, n_back: int,
+                 baseline_day: int, prev_year_end_day: int, window_day: int = -1) -> np.ndarray:
+    """
+    Bases for one ticker, shape (len(FLAVOURS), len(BASE_FIELDS)), NaN when missing:
+    last close on/before target_day, the close n_back bars before it (only if
+    on/after window_day, the start of the fetched target window: bars are
+    fetched in separate windows, so counting back past a gap would land in
+    another one), the close on/before baseline_day (-1 = none) and on/before
+    prev_year_end_day.
+    days: ascending int day numbers; closes: float array (len(days), len(FLAVOURS)).
+    """
+    out = np.full((closes.shape[1], len(BASE_FIELDS)), np.nan)
+    pos = int(np.searchsorted(days, target_day, side="right")) - 1
+    if pos < 0:
+        return out
+    out[:, 0] = closes[pos]
+    if pos - n_back >= 0 and days[pos - n_back] >= window_day:
+        out[:, 1] = closes[pos - n_back]
+    if baseline_day >= 0:
+        b = int(np.searchsorted(days, baseline_day, side="right")) - 1
+        if b >= 0:
+            out[:, 2] = closes[b]
+    p = int(np.searchsorted(days, prev_year_end_day, side="right")) - 1
+    if p >= 0:
+        out[:, 3] = closes[p]
+    return out
+
+def _empty_bars() -> tuple:
+    return np.empty(0, np.int64), np.empty((0, len(FLAVOURS)))
+
+def chart_arrays(data: Optional[dict]) -> tuple:
+    """Decode a Yahoo chart payload into (session day numbers, closes[:, Close/Adj Close]); empty if unusable."""
+    if not data or (data.get("chart") or {}).get("error") is not None:
+        return _empty_bars()
+    try:
+        result = data["chart"]["result"][0]
+        tzname = result.get("meta", {}).get("exchangeTimezoneName", "UTC")
+        stamps = result.get("timestamp", []) or []
+        indicators = result.get("indicators", {})
+        closes = indicators.get("quote", [{}])[0].get("close", []) or []
+        adj = (indicators.get("adjclose") or [{}])[0].get("adjclose") or closes
+        n = min(len(stamps), len(closes), len(adj))
+        if not n:
+            return _empty_bars()
+        local = pd.to_datetime(stamps[:n], unit="s", utc=True).tz_convert(tzname).tz_localize(None)
+        days = local.to_numpy().astype("datetime64[D]").astype(np.int64)
+        vals = np.array([closes[:n], adj[:n]], dtype=float).T  # None -> NaN
+        keep = ~np.isnan(vals[:, 0])
+        return days[keep], vals[keep]
+    except Exception:
+        return _empty_bars()
+
+def decode_chart(raw: Optional[bytes]) -> tuple:
+    """chart_arrays for an undecoded payload body."""
+    try:
+        return chart_arrays(json.loads(raw)) if raw else _empty_bars()
+    except ValueError:
+        return _empty_bars()
+
+def merge_bars(parts) -> tuple:
+    """Concatenate (days, closes) parts into one ascending series; a repeated day keeps the later part's bar."""
+    parts = [p for p in parts if len(p[0])]
+    if not parts:
+        return _empty_bars()
+    days = np.concatenate([d for d, _ in parts])
+    closes = np.concatenate([c for _, c in parts])
+    order = np.argsort(days, kind="stable")
+    days, closes = days[order], closes[order]
+    last = np.r_[days[1:] != days[:-1], True]
+    return days[last], closes[last]
+
+def decode_shard(shard: tuple) -> tuple:
+    """
+    Worker entry point. shard = (target_day, n_back, prev_year_end_day, jobs),
+    jobs = [(payloads, baseline_day, window_day), ...] with one raw chart
+    payload per fetched window. Returns (bases (n, len(FLAVOURS), len(BASE_FIELDS)),
+    bar counts (n,), days, closes) with every ticker's bars concatenated in job order.
+    """
+    target_day, n_back, prev_year_end_day, jobs = shard
+    bases = np.full((len(jobs), len(FLAVOURS), len(BASE_FIELDS)), np.nan)
+    lengths = np.zeros(len(jobs), dtype=np.int64)
+    all_days, all_closes = [], []
+    for i, (payloads, baseline_day, window_day) in enumerate(jobs):
+        days, closes = merge_bars([decode_chart(p) for p in payloads])
+        lengths[i] = len(days)
+        if len(days):
+            bases[i] = ticker_bases(days, closes, target_day, n_back, baseline_day, prev_year_end_day, window_day)
+        all_days.append(days)
+        all_closes.append(closes)
+    empty_days, empty_closes = _empty_bars()
+    return (bases, lengths,
+            np.concatenate(all_days) if all_days else empty_days,
+            np.concatenate(all_closes) if all_closes else empty_closes)
+
+def new_executor(processes: int) -> ProcessPoolExecutor:
+    # spawn: forking a process that runs server threads is not safe
+    return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+
+def decode_bases(jobs, target_day: int, n_back: int, prev_year_end_day: int,
+                 executor: Optional[ProcessPoolExecutor] = None, processes: int = 0) -> tuple:
+    """
+    decode_shard over every job, in order. With an executor and enough jobs
+    the work is split into contiguous shards across its processes.
+    """
+    if executor is None or processes <= 1 or len(jobs) < POOL_MIN_TICKERS:
+        return decode_shard((target_day, n_back, prev_year_end_day, list(jobs)))
+    n_shards = min(len(jobs), processes * SHARDS_PER_PROCESS)
+    bounds = np.linspace(0, len(jobs), n_shards + 1).astype(int)
+    shards = [(target_day, n_back, prev_year_end_day, list(jobs[a:b])) for a, b in zip(bounds[:-1], bounds[1:])]
+    parts = list(executor.map(decode_shard, shards))
+    return tuple(np.concatenate([p[k] for p in parts]) for k in range(4))
+
+# -----------------------------
+# Benchmark
+# -----------------------------
+def synthetic_payload(n_bars: int, rng, start: date = date(2024, 1, 1)) -> bytes:
+    """A Yahoo-shaped daily chart payload (New York session closes), as fetched."""
+    days = pd.bdate_range(start, periods=n_bars)
+    stamps = (days + pd.Timedelta(hours=20)).to_numpy().astype("datetime64[s]").astype(np.int64).tolist()  # 16:00 New York
+    close = (100.0 * np.exp(np.cumsum(rng.normal(0, 0.01, n_bars)))).round(4)
+    return json.dumps({"chart": {"error": None, "result": [{
+        "meta": {"exchangeTimezoneName": "America/New_York"},
+        "timestamp": stamps,
+        "indicators": {"quote": [{"close": close.tolist()}], "adjclose": [{"adjclose": (close * 0.98).round(4).tolist()}]},
+    }]}}).encode("utf-8")
+
+def synthetic_jobs(n_tickers: int, n_bars: int = 260, seed: int = 0) -> list:
+    rng = np.random.default_rng(seed)
+    return [((synthetic_payload(n_bars, rng),), -1, -1) for _ in range(n_tickers)]
+
+def benchmark(ticker_counts=(1000, 4000, 16000), process_counts=None, n_bars: int = 260, repeat: int = 3) -> list:
+    """
+    Best-of-repeat seconds for decode_bases (raw payloads -> bases) per universe
+    size and process count (1 = the in-process path), with speedup against it.
+    Pools are warmed first. `cpus` records the cores the curve was measured on.
+    """
+    cpus = os.cpu_count() or 1
+    if process_counts is None:
+        process_counts = sorted({1, 2, 4, 8, cpus} & set(range(1, cpus + 1)))
+    results = []
+    executors = {p: new_executor(p) for p in process_counts if p > 1}
+    try:
+        warm = synthetic_jobs(POOL_MIN_TICKERS, 10)
+        for p, ex in executors.items():
+            decode_bases(warm, 0, 5, 0, ex, p)
+        for n in ticker_counts:
+            jobs = synthetic_jobs(n, n_bars)
+            target_day = day_number(date(2024, 1, 1)) + n_bars * 2
+            single = None
+            for p in process_counts:
+                best = float("inf")
+                for _ in range(repeat):
+                    t0 = time.perf_counter()
+                    decode_bases(jobs, target_day, 5, target_day - 120, executors.get(p), p)
+                    best = min(best, time.perf_counter() - t0)
+                single = best if p == 1 else single
+                results.append({"tickers": n, "processes": p, "cpus": cpus, "seconds": round(best, 4),
+                                "speedup": round(single / best, 2) if single else None})
+    finally:
+        for ex in executors.values():
+            ex.shutdown(wait=False, cancel_futures=True)
+    return results
+
+if __name__ == "__main__":
+    for r in benchmark():
+        print(f"{r['tickers']:>7} tickers  {r['processes']:>2} proc / {r['cpus']} cpus  {r['seconds']:>8.4f}s  x{r['speedup']}")